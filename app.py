@@ -1,9 +1,11 @@
+import hmac
 import os
 import secrets
-from flask import Flask, abort, request, session
+from flask import Flask, abort, g, request, session
 
 from database.db import db, init_db
-from core.helpers import register_context_processors
+from core.helpers import OrjsonProvider, register_context_processors
+from core.log_writer import register_log_writer
 from routes.auth import register_auth
 from routes.dashboard import register_dashboard
 from routes.dispatches import register_dispatches
@@ -27,9 +29,11 @@ def create_app():
     app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
     app.config['SESSION_COOKIE_HTTPONLY'] = True
     os.makedirs(app.config['UPLOAD_DIR'], exist_ok=True)
+    app.json = OrjsonProvider(app)
 
     init_db(app)
     register_context_processors(app)
+    register_log_writer(app)
 
     register_auth(app)
     register_profile(app)
@@ -43,12 +47,17 @@ def create_app():
 
     @app.before_request
     def csrf_protect():
-        # Genera token si no existe (también manejado en context_processor)
-        if 'csrf_token' not in session:
-            session['csrf_token'] = secrets.token_hex(16)
+        # una sola lectura de session por request; el token queda en g
+        # para que el context processor no repita el lookup
+        expected = session.get('csrf_token')
+        if not expected:
+            expected = secrets.token_hex(16)
+            session['csrf_token'] = expected
+        g.csrf_token = expected
         if request.method in ('POST', 'PUT', 'PATCH', 'DELETE'):
             token = request.headers.get('X-CSRFToken') or request.form.get('csrf_token')
-            if not token or token != session.get('csrf_token'):
+            # compare_digest: comparación en tiempo constante
+            if not token or not hmac.compare_digest(token, expected):
                 abort(403)
 
     return app
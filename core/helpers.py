@@ -1,42 +1,82 @@
-import bleach
+import html
+import orjson
+import re
 import secrets
-from functools import wraps
-from flask import render_template, request, session, redirect, url_for, current_app
+from datetime import datetime
+from functools import lru_cache, wraps
+from flask import render_template, request, session, redirect, url_for, current_app, g
+from flask.json.provider import JSONProvider
 
-# Sanitization defaults shared across the app
-ALLOWED_TAGS = []
-ALLOWED_ATTRS = {}
+# La política de sanitización es "ningún tag permitido", así que basta un
+# regex precompilado en vez del parser html5lib completo de bleach.
+_TAG_RE = re.compile(r'<[^>]*>')
+
+# fechas 'dd/mm/aaaa' de los filtros; admite día/mes sin cero a la izquierda
+_DMY_RE = re.compile(r'^\s*(\d{1,2})/(\d{1,2})/(\d{4})\s*$')
+
+
+class OrjsonProvider(JSONProvider):
+    """Serializador JSON respaldado por orjson (C), mucho más rápido que
+    el json de la stdlib para los listados largos de las APIs."""
+
+    def dumps(self, obj, **kwargs):
+        # str por compatibilidad con la cookie de sesión firmada
+        return orjson.dumps(obj, default=str).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # bytes directo, sin pasar por str
+        return current_app.response_class(
+            orjson.dumps(obj, default=str), mimetype='application/json'
+        )
+
+
+@lru_cache(maxsize=8192)
+def _clean_text_cached(s: str) -> str:
+    if not s or ('<' not in s and '>' not in s and '&' not in s):
+        # camino rápido: el input normal de formularios no trae HTML
+        return s
+    s = html.unescape(_TAG_RE.sub('', s))
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
 
 def clean_text(value: str) -> str:
-    """Sanitize incoming text fields with shared bleach rules."""
-    return bleach.clean(
-        (value or '').strip(),
-        tags=ALLOWED_TAGS,
-        attributes=ALLOWED_ATTRS,
-        strip=True
-    )
+    """Sanitize incoming text fields: strip all tags, escape the rest."""
+    s = (value or '').strip()
+    if not s:
+        # las filas vacías del UI ni siquiera tocan el caché
+        return ''
+    # los mismos nombres/marcas se repiten entre requests: cache LRU
+    return _clean_text_cached(s)
 
 
 def get_json_body(default=None):
     """Safe JSON loader with predictable default."""
-    return request.get_json(silent=True) or (default if default is not None else {})
+    # orjson directo sobre los bytes crudos: evita el decode a str y los
+    # chequeos de mimetype de request.get_json
+    try:
+        parsed = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        parsed = None
+    return parsed or (default if default is not None else {})
 
 
 def render_view(template_name: str, **context):
-    """Render templates injecting session identity helpers."""
-    base_context = {
-        'name': session.get('name'),
-        'is_Admin': session.get('is_Admin', False)
-    }
-    base_context.update(context)
-    return render_template(template_name, **base_context)
+    """Render templates; name/is_Admin ya llegan vía context processor."""
+    # inject_globals inyecta la identidad de sesión en cada render, así
+    # que no hay que rearmar el dict ni repetir las lecturas de session
+    return render_template(template_name, **context)
 
 
 def register_context_processors(app):
     @app.context_processor
     def inject_globals():
-        token = session.get('csrf_token')
+        # csrf_protect ya dejó el token en g; session queda de respaldo
+        # para renders fuera del ciclo before_request (p. ej. errores)
+        token = getattr(g, 'csrf_token', None) or session.get('csrf_token')
         if not token:
             token = secrets.token_hex(16)
             session['csrf_token'] = token
@@ -74,11 +114,14 @@ def is_allowed_file(filename: str) -> bool:
 
 def parse_dmy(s: str):
     """Convierte 'dd/mm/aaaa' a datetime a las 00:00; devuelve None si no aplica."""
-    from datetime import datetime
+    # regex precompilada + constructor directo: strptime re-parsea el
+    # formato en cada llamada y esto corre por cada filtro de fecha
+    m = _DMY_RE.match(s or '')
+    if not m:
+        return None
     try:
-        d = datetime.strptime(s.strip(), "%d/%m/%Y")
-        return d
-    except Exception:
+        return datetime(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+    except ValueError:
         return None
 
 
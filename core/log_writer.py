@@ -0,0 +1,94 @@
+import atexit
+import queue
+import threading
+
+from database.db import Log, db, now_santiago
+
+# Escritor de logs en segundo plano: los registros de auditoría que no
+# necesitan viajar en la misma transacción del negocio se encolan aquí y
+# un hilo daemon los inserta por lotes, sacando el fsync del camino
+# crítico del request. Los logs que deben ser atómicos con la escritura
+# de negocio siguen usando db.session.add(Log(...)) inline.
+
+# valores por defecto; ajustables vía AUDIT_FLUSH_BATCH /
+# AUDIT_FLUSH_INTERVAL en la config de la app
+_MAX_BATCH = 500
+_FLUSH_TIMEOUT = 0.2
+_QUEUE_MAX = 10000
+
+_log_queue = queue.Queue(maxsize=_QUEUE_MAX)
+
+
+def queue_log(user_id, action, target_table=None, target_id=None, details=None):
+    """Encola un registro de auditoría para inserción en segundo plano."""
+    row = {
+        'user_id': user_id,
+        'action': action,
+        'target_table': target_table,
+        'target_id': target_id,
+        'details': details,
+        # la marca de tiempo es la del evento, no la del flush
+        'created_at': now_santiago(),
+    }
+    try:
+        _log_queue.put_nowait(row)
+    except queue.Full:
+        # cola saturada: dar una ventana al escritor y, si sigue llena,
+        # preferimos perder el log antes que bloquear el request
+        try:
+            _log_queue.put(row, timeout=_FLUSH_TIMEOUT)
+        except queue.Full:
+            pass
+
+
+def log_inline(user_id, action, target_table=None, target_id=None, details=None):
+    """Inserta un log vía Core dentro de la transacción actual.
+
+    Evita construir la instancia ORM y su paso por el identity map; el
+    commit sigue a cargo del caller, junto con la escritura de negocio."""
+    db.session.execute(Log.__table__.insert().values(
+        user_id=user_id,
+        action=action,
+        target_table=target_table,
+        target_id=target_id,
+        details=details,
+        created_at=now_santiago(),
+    ))
+
+
+def _drain(block=True):
+    batch = []
+    try:
+        if block:
+            batch.append(_log_queue.get(timeout=_FLUSH_TIMEOUT))
+        while len(batch) < _MAX_BATCH:
+            batch.append(_log_queue.get_nowait())
+    except queue.Empty:
+        pass
+    return batch
+
+
+def register_log_writer(app):
+    global _MAX_BATCH, _FLUSH_TIMEOUT
+    _MAX_BATCH = app.config.setdefault('AUDIT_FLUSH_BATCH', _MAX_BATCH)
+    _FLUSH_TIMEOUT = app.config.setdefault('AUDIT_FLUSH_INTERVAL', _FLUSH_TIMEOUT)
+
+    def _flush(batch):
+        if not batch:
+            return
+        with app.app_context():
+            db.session.execute(Log.__table__.insert(), batch)
+            db.session.commit()
+
+    def _worker():
+        while True:
+            try:
+                _flush(_drain())
+            except Exception:
+                app.logger.exception("Fallo escribiendo logs en lote")
+
+    thread = threading.Thread(target=_worker, name='log-writer', daemon=True)
+    thread.start()
+
+    # al apagar el proceso se vacía lo pendiente
+    atexit.register(lambda: _flush(_drain(block=False)))
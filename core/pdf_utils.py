@@ -1,27 +1,108 @@
+import io
 import os
+import tempfile
+from functools import lru_cache
 from fpdf import FPDF, HTMLMixin
 from fpdf.enums import XPos, YPos
 from flask import current_app
 
-from database.db import DispatchBatch, DispatchEntry, DispatchPhoto, PurchaseOrder
-from sqlalchemy.orm import joinedload
+from database.db import DispatchBatch, DispatchEntry, PurchaseOrder, db
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, selectinload
 from .helpers import to_iso
 
+# Caché in-process del PDF generado: cada click de descarga repetía todo
+# el trabajo de fpdf (fotos incluidas). Igual que las stats del
+# dashboard, cualquier commit lo invalida entero.
+_PDF_CACHE_MAX_ENTRIES = 16
+_PDF_CACHE_MAX_BYTES = 4 * 1024 * 1024
+_pdf_cache = {}
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_pdf_cache(session):
+    _pdf_cache.clear()
+
+
+def _pdf_cached(key):
+    data = _pdf_cache.get(key)
+    if data is not None:
+        return io.BytesIO(data)
+    return None
+
+
+def _pdf_remember(key, stream):
+    """Guarda el contenido del stream en el caché (si no es gigante) y
+    lo devuelve rebobinado."""
+    data = stream.read()
+    stream.seek(0)
+    if len(data) <= _PDF_CACHE_MAX_BYTES:
+        if len(_pdf_cache) >= _PDF_CACHE_MAX_ENTRIES:
+            _pdf_cache.pop(next(iter(_pdf_cache)))
+        _pdf_cache[key] = data
+    return stream
+
 
 class PDF(FPDF, HTMLMixin):
     pass
 
 
+def _pdf_to_stream(pdf: PDF):
+    """Vuelca el PDF a un SpooledTemporaryFile listo para send_file:
+    los reportes chicos quedan en RAM y los grandes (con fotos) se
+    derraman a disco en vez de inflar la memoria del proceso."""
+    tmp = tempfile.SpooledTemporaryFile(max_size=512 * 1024)
+    tmp.write(pdf.output())
+    tmp.seek(0)
+    return tmp
+
+
+class _Latin1Table(dict):
+    """Tabla para str.translate: deja pasar latin-1, mapea '—' a '-' y
+    memoriza '?' para cualquier otro codepoint la primera vez que aparece."""
+
+    def __missing__(self, cp):
+        self[cp] = 0x3F  # '?'
+        return 0x3F
+
+
+_PDF_CHAR_TABLE = _Latin1Table({cp: cp for cp in range(0x100)})
+_PDF_CHAR_TABLE[0x2014] = 0x2D  # '—' -> '-'
+
+
+@lru_cache(maxsize=4096)
 def _pdf_sanitize(text):
-    s = "-" if text in (None, "") else str(text)
-    s = s.replace("—", "-")
-    return s.encode('latin-1', 'replace').decode('latin-1')
+    # cacheado: en reportes largos los mismos valores (marcas, '-', …)
+    # se repiten en muchas celdas
+    if text in (None, ""):
+        return "-"
+    # una sola pasada en C, sin el round-trip encode/decode a latin-1
+    return str(text).translate(_PDF_CHAR_TABLE)
 
 
 def _wrap_pdf_text(text, width=50):
-    import textwrap
     s = _pdf_sanitize(text)
-    return "\n".join(textwrap.fill(s, width=width, break_long_words=True, break_on_hyphens=False).splitlines())
+    n = len(s)
+    if n <= width:
+        return s
+    # Corte estimado: saltamos de a `width` caracteres y sólo retrocedemos
+    # hasta el espacio más cercano, en vez del escaneo palabra a palabra
+    # de textwrap.
+    out = []
+    i = 0
+    while i < n:
+        if n - i <= width:
+            out.append(s[i:])
+            break
+        cut = s.rfind(' ', i, i + width + 1)
+        if cut <= i:
+            # palabra más larga que el ancho: corte duro
+            out.append(s[i:i + width])
+            i += width
+        else:
+            out.append(s[i:cut])
+            i = cut + 1
+    return "\n".join(out)
 
 
 def _pdf_header(pdf: PDF, title: str):
@@ -41,17 +122,19 @@ def _pdf_add_keyvals(pdf: FPDF, pairs):
     if not pairs:
         return
 
-    html = "<table border='1' width='100%' cellspacing='0' cellpadding='4'><tbody>"
+    # lista + join: concatenar con += recopia el string completo por fila
+    san = _pdf_sanitize
+    parts = ["<table border='1' width='100%' cellspacing='0' cellpadding='4'><tbody>"]
     for label, value in pairs:
-        safe_label = _pdf_sanitize(label)
-        safe_value = _pdf_sanitize(value if value not in (None, '') else '-')
-        html += "<tr>"
-        html += f"<td width='35%'><b>{safe_label}</b></td>"
-        html += f"<td width='65%'>{safe_value}</td>"
-        html += "</tr>"
-    html += "</tbody></table>"
-
-    pdf.write_html(html)
+        safe_label = san(label)
+        safe_value = san(value if value not in (None, '') else '-')
+        parts.append(
+            f"<tr><td width='35%'><b>{safe_label}</b></td>"
+            f"<td width='65%'>{safe_value}</td></tr>"
+        )
+    parts.append("</tbody></table>")
+
+    pdf.write_html("".join(parts))
     pdf.ln(4)
 
 
@@ -61,25 +144,43 @@ def _pdf_add_table_html(pdf: PDF, headers, rows):
     headers: lista de strings
     rows: lista de listas de strings
     """
-    html = "<table border='1' width='100%'><thead><tr>"
+    san = _pdf_sanitize
+    parts = ["<table border='1' width='100%'><thead><tr>"]
 
     for h in headers:
-        html += f"<th>{_pdf_sanitize(h)}</th>"
+        parts.append(f"<th>{san(h)}</th>")
 
-    html += "</tr></thead><tbody>"
+    parts.append("</tr></thead><tbody>")
 
     for row in rows:
-        html += "<tr>"
+        parts.append("<tr>")
         for col in row:
-            html += f"<td>{_pdf_sanitize(str(col))}</td>"
-        html += "</tr>"
+            parts.append(f"<td>{san(str(col))}</td>")
+        parts.append("</tr>")
 
-    html += "</tbody></table>"
+    parts.append("</tbody></table>")
 
-    pdf.write_html(html)
+    pdf.write_html("".join(parts))
     pdf.ln(4)
 
 
+@lru_cache(maxsize=256)
+def _photo_source(path):
+    # al subir cada foto se genera un thumbnail ~800px; para el ancho que
+    # usa el PDF basta y pesa una fracción del original. Fotos anteriores
+    # a ese cambio no lo tienen, así que se cae al archivo original.
+    thumb = f"{path}.thumb.jpg"
+    return thumb if os.path.exists(thumb) else path
+
+
+@lru_cache(maxsize=128)
+def _load_image(path, mtime):
+    # mtime en la clave: si la foto cambia en disco la entrada vieja
+    # deja de usarse sola
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
 def _pdf_add_photos(pdf: PDF, photos):
     if not photos:
         pdf.cell(
@@ -111,8 +212,13 @@ def _pdf_add_photos(pdf: PDF, photos):
         )
         pdf.set_font("Helvetica", "", 11)
         for p in plist:
-            path = os.path.join(current_app.root_path, 'static', p.path)
-            if os.path.exists(path):
+            path = _photo_source(os.path.join(current_app.root_path, 'static', p.path))
+            try:
+                # un solo stat: existencia + mtime para la clave del caché
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None:
                 pdf.cell(
                     0,
                     6,
@@ -122,7 +228,7 @@ def _pdf_add_photos(pdf: PDF, photos):
                 )
                 try:
                     avail = pdf.w - pdf.l_margin - pdf.r_margin
-                    pdf.image(path, w=min(150, avail))
+                    pdf.image(io.BytesIO(_load_image(path, st.st_mtime)), w=min(150, avail))
                     pdf.ln(4)
                 except Exception:
                     pdf.cell(
@@ -144,6 +250,11 @@ def _pdf_add_photos(pdf: PDF, photos):
 
 
 def build_dispatch_pdf(batch: DispatchBatch):
+    cache_key = ('despacho', batch.id)
+    cached = _pdf_cached(cache_key)
+    if cached is not None:
+        return cached
+
     pdf = PDF()
     pdf.set_auto_page_break(True, margin=15)
     pdf.add_page()
@@ -166,14 +277,18 @@ def build_dispatch_pdf(batch: DispatchBatch):
 
     _pdf_add_table_html(pdf, ["Producto", "Marca", "Cantidad"], items)
 
-    photos = DispatchPhoto.query.filter_by(batch_id=batch.id).order_by(DispatchPhoto.created_at).all()
-    _pdf_add_photos(pdf, photos)
+    # la ruta de exportación ya trae las fotos con joinedload; sólo ordenar
+    _pdf_add_photos(pdf, sorted(batch.photos, key=lambda p: p.created_at))
 
-    data = pdf.output()
-    return bytes(data) if isinstance(data, bytearray) else data
+    return _pdf_remember(cache_key, _pdf_to_stream(pdf))
 
 
 def build_order_pdf(order: PurchaseOrder):
+    cache_key = ('orden', order.id)
+    cached = _pdf_cached(cache_key)
+    if cached is not None:
+        return cached
+
     pdf = PDF()
     pdf.set_auto_page_break(True, margin=15)
     pdf.add_page()
@@ -194,9 +309,13 @@ def build_order_pdf(order: PurchaseOrder):
 
     _pdf_add_table_html(pdf, ["Producto", "Marca", "Cantidad"], items)
 
+    # colecciones con selectinload: dos joinedload de colección a la vez
+    # (entries y photos) producían un producto cartesiano por despacho
     batches = DispatchBatch.query.options(
-        joinedload(DispatchBatch.entries).joinedload(DispatchEntry.product),
-        joinedload(DispatchBatch.photos)
+        joinedload(DispatchBatch.client),
+        joinedload(DispatchBatch.user),
+        selectinload(DispatchBatch.entries).joinedload(DispatchEntry.product),
+        selectinload(DispatchBatch.photos)
     ).filter_by(order_number=order.number).all()
 
     if not batches:
@@ -235,5 +354,4 @@ def build_order_pdf(order: PurchaseOrder):
             _pdf_add_table_html(pdf, ["Producto", "Marca", "Cantidad"], b_items)
             _pdf_add_photos(pdf, b.photos)
 
-    data = pdf.output()
-    return bytes(data) if isinstance(data, bytearray) else data
+    return _pdf_remember(cache_key, _pdf_to_stream(pdf))
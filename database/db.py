@@ -1,16 +1,20 @@
 from flask_sqlalchemy import SQLAlchemy
-from dataclasses import dataclass, field
-from sqlalchemy import Column, Integer, String, DateTime, func, ForeignKey
+from sqlalchemy import Column, Index, Integer, String, DateTime, and_, event, func, ForeignKey, or_, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import EmailType
 from datetime import datetime
+from zoneinfo import ZoneInfo
 
-import pytz
+import sqlite3
 db = SQLAlchemy()
 
 
-ZONA_SANTIAGO = pytz.timezone('America/Santiago')
+# zoneinfo (stdlib, backend en C) en vez de pytz: now_santiago corre como
+# default en cada INSERT y la resolución de la zona pytz es puro Python
+ZONA_SANTIAGO = ZoneInfo('America/Santiago')
 
 
 def now_santiago():
@@ -20,21 +24,35 @@ def now_santiago():
 
 def init_db(app):
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///mydb.db'
+    # más conexiones en vuelo que el pool por defecto (5) para que las
+    # exportaciones de PDF o ingresos masivos no se bloqueen entre sí
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+        'pool_size': 20,
+        'max_overflow': 20,
+        'pool_recycle': 1800,
+    })
     db.init_app(app)
 
 
-@dataclass
-class Users(db.Model):
-    id: int = field(init=False)
-    username: str
-    password: str
-    email: str
-    name: str
-    is_Admin: bool
-    theme: str
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_conn, _record):
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    # WAL permite lectores concurrentes con un escritor y busy_timeout
+    # evita errores 'database is locked' inmediatos bajo carga
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    cur.execute('PRAGMA busy_timeout=5000')
+    # caché de páginas de 64 MB (negativo = KiB), temporales en memoria y
+    # mmap de 256 MB para que las lecturas salgan del page cache del SO
+    cur.execute('PRAGMA cache_size=-65536')
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.execute('PRAGMA mmap_size=268435456')
+    cur.close()
 
-    __allow_unmapped__ = True
 
+class Users(db.Model):
     id = Column(Integer, primary_key=True)
     username = Column(String(80), unique=True, nullable=False)
     name = Column(String(120), unique=True, nullable=False)
@@ -49,7 +67,8 @@ class Users(db.Model):
 
     @password.setter
     def password(self, raw_plaintext):
-        # bcrypt por defecto; salt y cost incorporados
+        # scrypt (C, vía OpenSSL) por defecto en Werkzeug 3; salt y cost
+        # incorporados en el hash
         self._password = generate_password_hash(raw_plaintext)
 
     def check_password(self, raw_plaintext) -> bool:
@@ -59,19 +78,18 @@ class Users(db.Model):
         return f"<User {self.username!r}, is_Admin={self.is_Admin}>"
 
 
-@dataclass
 class Product(db.Model):
-    id:    int = field(init=False)
-    name:  str
-    brand: str
-    stock: int
-
     __tablename__ = 'products'
     id = Column(Integer, primary_key=True)
     name = Column(String(120), nullable=False, index=True)
     brand = Column(String(80),  nullable=False, index=True)
     stock = Column(Integer,     default=0, nullable=False)
 
+    # sirve las búsquedas exactas case-insensitive de ingreso/despacho
+    __table_args__ = (
+        Index('ix_products_name_brand_lower', func.lower(name), func.lower(brand)),
+    )
+
     entries = relationship('InventoryEntry', back_populates='product')
     dispatches = relationship(
         'DispatchEntry',
@@ -87,17 +105,16 @@ class Product(db.Model):
         )
 
 
-dataclass
-
-
 class Client(db.Model):
-    id:   int = field(init=False)
-    name: str
-
     __tablename__ = 'clients'
     id = Column(Integer, primary_key=True)
     name = Column(String(120), unique=True, nullable=False, index=True)
 
+    # búsqueda case-insensitive por igualdad (despachos) vía índice
+    __table_args__ = (
+        Index('ix_clients_name_lower', func.lower(name), unique=True),
+    )
+
     orders = relationship('PurchaseOrder', back_populates='client', lazy=True)
     batches = relationship('DispatchBatch', back_populates='client')
 
@@ -105,20 +122,20 @@ class Client(db.Model):
         return f"<Client id={self.id!r} name={self.name!r}>"
 
 
-@dataclass
 class DispatchBatch(db.Model):
-    id:         int = field(init=False)
-    client_id:  int
-    user_id:    int
-    created_at: datetime = field(init=False)
-    order_number = Column(String(50), nullable=True)
-
     __tablename__ = 'dispatch_batches'
     id = Column(Integer, primary_key=True)
+    order_number = Column(String(50), nullable=True, index=True)
     client_id = Column(Integer, ForeignKey('clients.id'), nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'),   nullable=False)
     created_at = Column(DateTime, default=now_santiago,    nullable=False)
 
+    # (created_at, client_id) sirve el rango de 14 días del dashboard y
+    # el distinct de clientes recientes sin escanear la tabla
+    __table_args__ = (
+        Index('ix_dispatch_batches_created_client', created_at, client_id),
+    )
+
     client = relationship('Client', back_populates='batches')
     user = relationship('Users', backref='dispatch_batches')
     entries = relationship('DispatchEntry', back_populates='batch', lazy=True)
@@ -128,14 +145,7 @@ class DispatchBatch(db.Model):
         return f"<DispatchBatch id={self.id} client={self.client.name} at={self.created_at}>"
 
 
-@dataclass
 class DispatchEntry(db.Model):
-    id:         int = field(init=False)
-    batch_id:   int
-    product_id: int
-    quantity:   int
-    order_number: str = field(default=None)
-
     __tablename__ = 'dispatch_entries'
     id = Column(Integer, primary_key=True)
     batch_id = Column(Integer, ForeignKey(
@@ -143,10 +153,19 @@ class DispatchEntry(db.Model):
     product_id = Column(Integer, ForeignKey(
         'products.id'),         nullable=False)
     quantity = Column(Integer, nullable=False)
-    order_number = Column(String(50), nullable=True, index=True)
+    order_number = Column(String(50), nullable=True)
     created_at = Column(DateTime(timezone=True),
                         default=now_santiago, nullable=False)
 
+    # compuesto (order_number, product_id): sirve tanto los filtros por
+    # orden como los GROUP BY por producto de los detalles de órdenes,
+    # y reemplaza al índice simple sobre order_number
+    __table_args__ = (
+        Index('ix_dispatch_entries_order_product', order_number, product_id),
+        # (batch_id, quantity) cubre el join batch→entries con SUM(quantity)
+        Index('ix_dispatch_entries_batch_qty', batch_id, quantity),
+    )
+
     batch = relationship('DispatchBatch', back_populates='entries')
     product = relationship('Product',       back_populates='dispatches')
 
@@ -154,14 +173,7 @@ class DispatchEntry(db.Model):
         return f"<DispatchEntry id={self.id} prod={self.product.name} qty={self.quantity}>"
 
 
-@dataclass
 class DispatchPhoto(db.Model):
-    id:       int = field(init=False)
-    batch_id: int
-    stage:    str
-    path:     str
-    created_at: datetime = field(init=False)
-
     __tablename__ = 'dispatch_photos'
     id = Column(Integer, primary_key=True)
     batch_id = Column(Integer, ForeignKey('dispatch_batches.id'), nullable=False, index=True)
@@ -175,18 +187,13 @@ class DispatchPhoto(db.Model):
         return f"<DispatchPhoto batch={self.batch_id} stage={self.stage} path={self.path}>"
 
 
-@dataclass
 class IngresoBatch(db.Model):
-    id:         int = field(init=False)
-    user_id:    int
-    created_at: datetime = field(init=False)
-
     __tablename__ = 'ingreso_batches'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     created_at = Column(
         DateTime(timezone=True),
-        default=now_santiago,  # aquí usamos pytznullable
+        default=now_santiago,
         nullable=False)
     user = relationship('Users', backref='ingreso_batches')
     entries = relationship('InventoryEntry', back_populates='batch', lazy=True)
@@ -195,13 +202,7 @@ class IngresoBatch(db.Model):
         return f"<IngresoBatch id={self.id} by={self.user.username} on={self.created_at}>"
 
 
-@dataclass
 class InventoryEntry(db.Model):
-    id:         int = field(init=False)
-    ingreso_id: int
-    product_id: int
-    quantity:   int
-
     __tablename__ = 'inventory_entries'
     id = Column(Integer, primary_key=True)
     ingreso_id = Column(Integer,
@@ -217,16 +218,7 @@ class InventoryEntry(db.Model):
         return f"<Entry id={self.id} prod={self.product.name} qty={self.quantity}>"
 
 
-@dataclass
 class Log(db.Model):
-    id:           int = field(init=False)
-    user_id:      int
-    action:       str
-    target_table: str
-    target_id:    int
-    details:     str = field(default=None)
-    created_at:   datetime = field(init=False)
-
     __tablename__ = 'logs'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -240,6 +232,16 @@ class Log(db.Model):
         nullable=False
     )
 
+    # índices para los filtros de /api/logs: rango de fechas y
+    # acción/tabla combinadas con la fecha del ordenamiento
+    __table_args__ = (
+        Index('ix_log_created_at', created_at.desc()),
+        Index('ix_log_action_created', 'action', 'created_at'),
+        Index('ix_log_table_created', 'target_table', 'created_at'),
+        # historial por usuario ordenado por fecha (la tabla solo crece)
+        Index('ix_log_user_created', 'user_id', 'created_at'),
+    )
+
     # relación con el usuario que ejecutó la acción
     user = relationship('Users', backref='logs', lazy=True)
 
@@ -252,13 +254,7 @@ class Log(db.Model):
         )
 
 
-@dataclass
 class PurchaseOrder(db.Model):
-    id:          int = field(init=False)
-    number:      str
-    client_id:   int
-    created_at:  datetime = field(init=False)
-
     __tablename__ = 'purchase_orders'
     id = Column(Integer, primary_key=True)
     number = Column(String(50), unique=True, nullable=False, index=True)
@@ -271,20 +267,59 @@ class PurchaseOrder(db.Model):
                          back_populates='order', lazy=True)
 
 
-@dataclass
 class PurchaseOrderItem(db.Model):
-    id:        int = field(init=False)
-    order_id:  int
-    product_id: int
-    quantity:  int
-
     __tablename__ = 'purchase_order_items'
     id = Column(Integer, primary_key=True)
     order_id = Column(Integer, ForeignKey(
-        'purchase_orders.id'), nullable=False)
+        'purchase_orders.id'), nullable=False, index=True)
     product_id = Column(Integer, ForeignKey(
         'products.id'),         nullable=False)
     quantity = Column(Integer, nullable=False)
 
     order = relationship('PurchaseOrder', back_populates='items')
     product = relationship('Product')
+
+
+def get_or_create_client(name):
+    """Devuelve (id, name) del cliente, creándolo de forma atómica si no
+    existe: un INSERT ... ON CONFLICT DO NOTHING con RETURNING en vez del
+    select-luego-insert que corría carreras entre despachos concurrentes."""
+    row = db.session.execute(
+        sqlite_insert(Client)
+        .values(name=name)
+        .on_conflict_do_nothing()
+        .returning(Client.id, Client.name)
+    ).first()
+    if row is None:
+        # hubo conflicto: el cliente ya existía (quizás con otra caja)
+        row = db.session.execute(
+            select(Client.id, Client.name)
+            .where(func.lower(Client.name) == name.lower())
+        ).first()
+    return row
+
+
+def products_by_name_brand(pairs, for_update=False):
+    """Trae en una sola consulta los productos de los pares (nombre, marca).
+
+    Devuelve {(nombre.lower(), marca.lower()): Product} para que los
+    endpoints de ingreso/despacho resuelvan cada línea en memoria en
+    vez de lanzar una consulta por ítem.
+
+    Con for_update=True el SELECT bloquea las filas (FOR UPDATE) para
+    los caminos que leen y reescriben stock; en SQLite la cláusula se
+    ignora porque el lock de escritura es de base completa.
+    """
+    wanted = {(n.lower(), b.lower()) for n, b in pairs}
+    if not wanted:
+        return {}
+    # OR de igualdades en vez de IN de tuplas: SQLite sí resuelve esta
+    # forma con ix_products_name_brand_lower (MULTI-INDEX OR)
+    query = Product.query.filter(or_(*(
+        and_(func.lower(Product.name) == n, func.lower(Product.brand) == b)
+        for n, b in wanted
+    )))
+    if for_update:
+        query = query.with_for_update()
+    rows = query.all()
+    return {(p.name.lower(), p.brand.lower()): p for p in rows}
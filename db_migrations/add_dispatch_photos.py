@@ -10,10 +10,16 @@ en la carpeta instance/. No borra datos ni modifica tablas existentes.
 
 import os
 import sqlite3
+from functools import lru_cache
 from pathlib import Path
 
 
+@lru_cache(maxsize=1)
 def find_db():
+    # MYDB_PATH evita el sondeo del filesystem en despliegues en contenedor
+    env_path = os.environ.get("MYDB_PATH")
+    if env_path:
+        return Path(env_path)
     candidates = [
         Path("mydb.db"),
         Path("instance") / "mydb.db",
@@ -27,21 +33,23 @@ def find_db():
 def run_migration():
     db_path = find_db()
     conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS dispatch_photos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        batch_id INTEGER NOT NULL,
-        stage TEXT NOT NULL,
-        path TEXT NOT NULL,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(batch_id) REFERENCES dispatch_batches(id)
-    );
-    """)
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_dispatch_photos_batch ON dispatch_photos(batch_id);")
-
-    conn.commit()
+    # WAL: los lectores concurrentes no se bloquean mientras migra
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    # una sola transacción para toda la migración (commit al salir del with)
+    with conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS dispatch_photos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            path TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(batch_id) REFERENCES dispatch_batches(id)
+        );
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_dispatch_photos_batch ON dispatch_photos(batch_id);")
+
     conn.close()
     print(f"Tabla dispatch_photos verificada en {db_path}")
 
@@ -0,0 +1,80 @@
+"""
+Script de migración para agregar los índices de performance a bases ya
+existentes (las bases nuevas los reciben vía create_all desde los modelos).
+
+Uso:
+    python db_migrations/add_perf_indexes.py
+
+El script intenta ubicar el archivo SQLite (mydb.db) en la raíz del proyecto o
+en la carpeta instance/. Todos los CREATE INDEX usan IF NOT EXISTS, así que es
+seguro correrlo más de una vez.
+"""
+
+import os
+import sqlite3
+from functools import lru_cache
+from pathlib import Path
+
+INDEXES = [
+    # búsqueda case-insensitive de productos y clientes
+    "CREATE INDEX IF NOT EXISTS ix_products_name_brand_lower "
+    "ON products(lower(name), lower(brand));",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_clients_name_lower "
+    "ON clients(lower(name));",
+    # filtros y agregados por número de orden
+    "CREATE INDEX IF NOT EXISTS ix_dispatch_entries_order_product "
+    "ON dispatch_entries(order_number, product_id);",
+    "CREATE INDEX IF NOT EXISTS ix_dispatch_batches_order_number "
+    "ON dispatch_batches(order_number);",
+    "CREATE INDEX IF NOT EXISTS ix_purchase_order_items_order_id "
+    "ON purchase_order_items(order_id);",
+    # serie de 14 días y clientes recientes del dashboard
+    "CREATE INDEX IF NOT EXISTS ix_dispatch_batches_created_client "
+    "ON dispatch_batches(created_at, client_id);",
+    # join batch→entries con SUM(quantity)
+    "CREATE INDEX IF NOT EXISTS ix_dispatch_entries_batch_qty "
+    "ON dispatch_entries(batch_id, quantity);",
+    # listado y filtros del historial de auditoría
+    "CREATE INDEX IF NOT EXISTS ix_log_created_at ON logs(created_at DESC);",
+    "CREATE INDEX IF NOT EXISTS ix_log_action_created "
+    "ON logs(action, created_at);",
+    "CREATE INDEX IF NOT EXISTS ix_log_table_created "
+    "ON logs(target_table, created_at);",
+    "CREATE INDEX IF NOT EXISTS ix_log_user_created "
+    "ON logs(user_id, created_at);",
+]
+
+
+@lru_cache(maxsize=1)
+def find_db():
+    # MYDB_PATH evita el sondeo del filesystem en despliegues en contenedor
+    env_path = os.environ.get("MYDB_PATH")
+    if env_path:
+        return Path(env_path)
+    candidates = [
+        Path("mydb.db"),
+        Path("instance") / "mydb.db",
+    ]
+    for path in candidates:
+        if path.exists():
+            return path
+    raise SystemExit("No se encontró mydb.db; ejecuta esto desde la raíz del proyecto.")
+
+
+def run_migration():
+    db_path = find_db()
+    conn = sqlite3.connect(db_path)
+    # WAL: los lectores concurrentes no se bloquean mientras migra
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    # una sola transacción para todos los índices (un fsync, no uno por DDL)
+    with conn:
+        for stmt in INDEXES:
+            conn.execute(stmt)
+
+    conn.close()
+    print(f"Índices verificados en {db_path}")
+
+
+if __name__ == "__main__":
+    run_migration()
@@ -3,19 +3,28 @@ from flask import jsonify, redirect, render_template, request, session, url_for
 from sqlalchemy.exc import SQLAlchemyError
 
 from core.helpers import clean_text, get_json_body, render_view
-from database.db import Log, Users, db
+from core.log_writer import queue_log
+from database.db import Users, db
 
 
 def register_auth(app):
+    # Una vez visto el primer usuario el chequeo queda en memoria y no
+    # vuelve a tocar la base en cada request.
+    app._has_any_user = False
+
     @app.before_request
     def ensure_first_user():
-        if Users.query.count() == 0:
-            if request.endpoint not in ('setup', 'static', 'login'):
-                return redirect(url_for('setup'))
+        if app._has_any_user:
+            return
+        if db.session.query(Users.id).limit(1).first() is not None:
+            app._has_any_user = True
+            return
+        if request.endpoint not in ('setup', 'static', 'login'):
+            return redirect(url_for('setup'))
 
     @app.route('/setup', methods=['GET', 'POST'])
     def setup():
-        if Users.query.count() > 0:
+        if app._has_any_user or db.session.query(Users.id).limit(1).first() is not None:
             return redirect(url_for('login'))
 
         if request.method == 'GET':
@@ -47,6 +56,7 @@ def register_auth(app):
             user.password = password
             db.session.add(user)
             db.session.commit()
+            app._has_any_user = True
             return jsonify(message="Usuario administrador creado"), 201
 
         except SQLAlchemyError:
@@ -77,15 +87,17 @@ def register_auth(app):
         session['user_id'] = user.id
         session['is_Admin'] = user.is_Admin
         session['name'] = user.name
+        session['username'] = user.username
+        session['email'] = user.email
         session['theme'] = user.theme
-        db.session.add(Log(
+        # auditoría en segundo plano: el login no espera el commit del log
+        queue_log(
             user_id=user.id,
             action='login',
             target_table='users',
             target_id=user.id,
             details=f"Inicio de sesión de {user.username}"
-        ))
-        db.session.commit()
+        )
         return jsonify({
             "user_id": user.id,
             "username": user.username
@@ -95,17 +107,13 @@ def register_auth(app):
     def logout():
         user_id = session.get('user_id')
         username = session.get('name')
-        try:
-            if user_id:
-                db.session.add(Log(
-                    user_id=user_id,
-                    action='logout',
-                    target_table='users',
-                    target_id=user_id,
-                    details=f"Cierre de sesión de {username or 'usuario'}"
-                ))
-                db.session.commit()
-        except SQLAlchemyError:
-            db.session.rollback()
+        if user_id:
+            queue_log(
+                user_id=user_id,
+                action='logout',
+                target_table='users',
+                target_id=user_id,
+                details=f"Cierre de sesión de {username or 'usuario'}"
+            )
         session.clear()
         return redirect(url_for('index'))
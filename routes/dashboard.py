@@ -1,90 +1,121 @@
+import time
 from datetime import datetime, timedelta
 from flask import render_template
-from sqlalchemy import func
-from sqlalchemy.orm import joinedload
+from sqlalchemy import bindparam, event, func, select, text
 
 from core.helpers import login_required, render_view
 from database.db import Client, DispatchBatch, DispatchEntry, Product, PurchaseOrder, PurchaseOrderItem, db
 
+# Caché in-process del dict de stats: el dashboard lo golpea cada pestaña
+# abierta pero los números no cambian segundo a segundo.
+_STATS_TTL = 15
+_stats_cache = {}
+
+# Sentencias construidas una vez al importar: Core select sin hidratación
+# ORM y sin rearmar el árbol de la consulta en cada request.
+_KPI_STMT = select(
+    select(func.count(Product.id)).scalar_subquery().label('productos'),
+    select(func.coalesce(func.sum(Product.stock), 0)).scalar_subquery().label('stock'),
+    select(func.count(DispatchBatch.id)).scalar_subquery().label('despachos'),
+    select(func.count(Client.id)).scalar_subquery().label('clientes'),
+    select(func.count(Product.id)).where(Product.stock <= 5).scalar_subquery().label('criticos'),
+    select(func.count(func.distinct(DispatchBatch.client_id)))
+    .where(DispatchBatch.created_at >= bindparam('cutoff'))
+    .scalar_subquery().label('clientes_30'),
+)
+
+_TOP_CLIENTS_STMT = (
+    select(
+        Client.name.label('client'),
+        func.count(DispatchBatch.id).label('despachos'),
+        func.coalesce(func.sum(DispatchEntry.quantity), 0).label('unidades')
+    )
+    .join(DispatchBatch, DispatchBatch.client_id == Client.id)
+    .outerjoin(DispatchEntry, DispatchEntry.batch_id == DispatchBatch.id)
+    .group_by(Client.id)
+    .order_by(func.coalesce(func.sum(DispatchEntry.quantity), 0).desc())
+    .limit(3)
+)
+
+_DESP_SQ = (
+    select(
+        DispatchBatch.order_number.label('order_number'),
+        func.sum(DispatchEntry.quantity).label('despachadas')
+    )
+    .join(DispatchEntry, DispatchEntry.batch_id == DispatchBatch.id)
+    .where(DispatchBatch.order_number.isnot(None))
+    .group_by(DispatchBatch.order_number)
+    .subquery()
+)
+
+_ORDER_STATUS_STMT = (
+    select(
+        PurchaseOrder.number,
+        func.coalesce(func.sum(PurchaseOrderItem.quantity), 0).label('solicitadas'),
+        func.coalesce(func.max(_DESP_SQ.c.despachadas), 0).label('despachadas')
+    )
+    .outerjoin(PurchaseOrderItem, PurchaseOrderItem.order_id == PurchaseOrder.id)
+    .outerjoin(_DESP_SQ, _DESP_SQ.c.order_number == PurchaseOrder.number)
+    .group_by(PurchaseOrder.number)
+)
+
 
 def register_dashboard(app):
+    @event.listens_for(db.session, 'after_commit')
+    def _invalidate_stats(session):
+        # cualquier escritura confirmada refresca el dashboard
+        _stats_cache.clear()
+
     @app.route('/dashboard')
     @login_required
     def dashboard():
-        total_products = db.session.query(func.count(Product.id)).scalar() or 0
-        total_stock = db.session.query(func.coalesce(func.sum(Product.stock), 0)).scalar() or 0
-        total_despachos_batches = db.session.query(func.count(DispatchBatch.id)).scalar() or 0
-        total_clientes = db.session.query(func.count(Client.id)).scalar() or 0
-        stock_critico = db.session.query(func.count(Product.id)).filter(Product.stock <= 5).scalar() or 0
-        clientes_ult_30 = db.session.query(func.count(func.distinct(DispatchBatch.client_id))) \
-            .filter(DispatchBatch.created_at >= datetime.utcnow() - timedelta(days=30)) \
-            .scalar() or 0
+        cached = _stats_cache.get('stats')
+        if cached is not None and time.monotonic() - cached[0] < _STATS_TTL:
+            return render_view("dashboard.html", stats=cached[1])
+        # Los seis KPIs escalares viajan en un solo SELECT (una ida al DB
+        # en vez de seis) usando subconsultas escalares.
+        kpis = db.session.execute(
+            _KPI_STMT, {'cutoff': datetime.utcnow() - timedelta(days=30)}
+        ).one()
+        total_products = kpis.productos or 0
+        total_stock = kpis.stock or 0
+        total_despachos_batches = kpis.despachos or 0
+        total_clientes = kpis.clientes or 0
+        stock_critico = kpis.criticos or 0
+        clientes_ult_30 = kpis.clientes_30 or 0
 
         today = datetime.utcnow().date()
         start_date = today - timedelta(days=13)
-        dispatch_rows = (
-            db.session.query(
-                func.date(DispatchBatch.created_at).label('day'),
-                func.count(DispatchBatch.id).label('count')
+        # La serie completa (incluidos los días en cero) sale del DB: un
+        # CTE recursivo genera los 14 días y el LEFT JOIN aporta el conteo.
+        dispatch_rows = db.session.execute(text("""
+            WITH RECURSIVE days(day) AS (
+                SELECT date(:start)
+                UNION ALL
+                SELECT date(day, '+1 day') FROM days WHERE day < date(:today)
             )
-            .filter(DispatchBatch.created_at >= start_date)
-            .group_by(func.date(DispatchBatch.created_at))
-            .order_by(func.date(DispatchBatch.created_at))
-            .all()
-        )
-        dispatch_map = {str(row.day): row.count for row in dispatch_rows}
-        dispatch_series = [
-            {
-                'day': (start_date + timedelta(days=offset)).isoformat(),
-                'count': dispatch_map.get((start_date + timedelta(days=offset)).isoformat(), 0)
-            }
-            for offset in range(14)
-        ]
+            SELECT days.day AS day, COALESCE(cnt.n, 0) AS count
+            FROM days
+            LEFT JOIN (
+                SELECT date(created_at) AS d, COUNT(id) AS n
+                FROM dispatch_batches
+                WHERE created_at >= :start
+                GROUP BY d
+            ) cnt ON cnt.d = days.day
+            ORDER BY days.day
+        """), {'start': start_date.isoformat(), 'today': today.isoformat()}).all()
+        dispatch_series = [{'day': row.day, 'count': row.count} for row in dispatch_rows]
 
-        top_clients = (
-            db.session.query(
-                Client.name.label('client'),
-                func.count(DispatchBatch.id).label('despachos'),
-                func.coalesce(func.sum(DispatchEntry.quantity), 0).label('unidades')
-            )
-            .join(DispatchBatch, DispatchBatch.client_id == Client.id)
-            .outerjoin(DispatchEntry, DispatchEntry.batch_id == DispatchBatch.id)
-            .group_by(Client.id)
-            .order_by(func.coalesce(func.sum(DispatchEntry.quantity), 0).desc())
-            .limit(3)
-            .all()
-        )
+        top_clients = db.session.execute(_TOP_CLIENTS_STMT).all()
         top_clients = [
             {'client': row.client, 'despachos': row.despachos, 'unidades': row.unidades}
             for row in top_clients
         ]
 
-        orders = PurchaseOrder.query.options(joinedload(PurchaseOrder.items)).all()
         status_totals = {'completas': 0, 'parciales': 0, 'pendientes': 0}
-        order_totals = {
-            row.number: row.solicitadas
-            for row in db.session.query(
-                PurchaseOrder.number,
-                func.coalesce(func.sum(PurchaseOrderItem.quantity), 0).label('solicitadas')
-            )
-            .outerjoin(PurchaseOrderItem, PurchaseOrderItem.order_id == PurchaseOrder.id)
-            .group_by(PurchaseOrder.number)
-            .all()
-        }
-        dispatch_totals = {
-            row.order_number: row.despachadas
-            for row in db.session.query(
-                DispatchBatch.order_number,
-                func.coalesce(func.sum(DispatchEntry.quantity), 0).label('despachadas')
-            )
-            .join(DispatchEntry, DispatchEntry.batch_id == DispatchBatch.id)
-            .filter(DispatchBatch.order_number.isnot(None))
-            .group_by(DispatchBatch.order_number)
-            .all()
-        }
-        for po in orders:
-            solicitadas = order_totals.get(po.number, 0)
-            despachadas = dispatch_totals.get(po.number, 0)
+        order_rows = db.session.execute(_ORDER_STATUS_STMT).all()
+        for row in order_rows:
+            solicitadas, despachadas = row.solicitadas, row.despachadas
 
             if solicitadas <= 0:
                 status_totals['pendientes'] += 1
@@ -100,11 +131,12 @@ def register_dashboard(app):
             'stock_total': total_stock,
             'despachos_batches': total_despachos_batches,
             'clientes': total_clientes,
-            'ordenes': len(orders),
+            'ordenes': len(order_rows),
             'stock_critico': stock_critico,
             'clientes_ult_30': clientes_ult_30,
             'ordenes_status': status_totals,
             'dispatch_series': dispatch_series,
             'top_clients': top_clients
         }
+        _stats_cache['stats'] = (time.monotonic(), stats)
         return render_view("dashboard.html", stats=stats)
@@ -1,10 +1,11 @@
-import io
 import os
 import time
-from flask import jsonify, redirect, render_template, request, session, send_file, url_for, current_app
+import orjson
+from flask import Response, jsonify, redirect, render_template, request, session, send_file, stream_with_context, url_for, current_app
 from werkzeug.utils import secure_filename
+from PIL import Image, ImageOps, UnidentifiedImageError
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
 
 from core.helpers import clean_text, get_json_body, is_allowed_file, login_required, render_view, to_iso
 from core.pdf_utils import build_dispatch_pdf
@@ -14,9 +15,10 @@ from database.db import (
     DispatchEntry,
     DispatchPhoto,
     Log,
-    Product,
     Users,
     db,
+    get_or_create_client,
+    products_by_name_brand,
 )
 
 
@@ -35,17 +37,31 @@ def register_dispatches(app):
         if not client_name:
             return jsonify(error="Debes indicar el nombre del cliente"), 400
 
-        client = Client.query.filter(Client.name.ilike(client_name)).first()
-        if not client:
-            client = Client(name=client_name)
-            db.session.add(client)
-            db.session.flush()
+        # upsert atómico: busca o crea el cliente en una sola sentencia
+        client = get_or_create_client(client_name)
 
         if not isinstance(items, list) or not items:
             return jsonify(error="Envía array 'items' con al menos un producto"), 400
 
+        cleaned = []
+        for idx, it in enumerate(items):
+            qty = it.get('quantity')
+            if not isinstance(qty, int) or qty <= 0:
+                return jsonify(error=f"Item {idx}: 'quantity' debe ser entero >0"), 400
+
+            name = clean_text(it.get('name', ''))
+            brand = clean_text(it.get('brand', ''))
+            if not name or not brand:
+                return jsonify(error=f"Item {idx}: faltan 'name' o 'brand'"), 400
+
+            cleaned.append((name, brand, qty))
+
+        # todos los productos del despacho en una sola consulta
+        index = products_by_name_brand(((n, b) for n, b, _ in cleaned), for_update=True)
+
         warnings = []
         processed = []
+        log_rows = []
 
         batch = DispatchBatch(
             client_id=client.id,
@@ -57,23 +73,9 @@ def register_dispatches(app):
 
         order_number = order_number or None
 
-        for idx, it in enumerate(items):
-            raw_name = it.get('name', '')
-            raw_brand = it.get('brand', '')
-            qty = it.get('quantity')
-
-            if not isinstance(qty, int) or qty <= 0:
-                return jsonify(error=f"Item {idx}: 'quantity' debe ser entero >0"), 400
-
-            name = clean_text(raw_name)
-            brand = clean_text(raw_brand)
-            if not name or not brand:
-                return jsonify(error=f"Item {idx}: faltan 'name' o 'brand'"), 400
-
-            prod = Product.query.filter(
-                Product.name.ilike(f"%{name}%"),
-                Product.brand.ilike(f"%{brand}%")
-            ).first()
+        entry_rows = []
+        for idx, (name, brand, qty) in enumerate(cleaned):
+            prod = index.get((name.lower(), brand.lower()))
             if not prod:
                 return jsonify(error=f"Item {idx}: producto no existe en inventario"), 400
 
@@ -85,14 +87,12 @@ def register_dispatches(app):
                 )
             prod.stock = max(prod.stock - qty, 0)
 
-            entry = DispatchEntry(
-                batch_id=batch.id,
-                product_id=prod.id,
-                quantity=dispatched,
-                order_number=order_number
-            )
-            db.session.add(entry)
-            db.session.flush()
+            entry_rows.append({
+                'batch_id': batch.id,
+                'product_id': prod.id,
+                'quantity': dispatched,
+                'order_number': order_number
+            })
 
             processed.append({
                 'product': {'id': prod.id, 'name': prod.name, 'brand': prod.brand},
@@ -100,22 +100,33 @@ def register_dispatches(app):
                 'dispatched': dispatched
             })
 
-            db.session.add(Log(
-                user_id=session['user_id'],
-                action='dispatch_product',
-                target_table='dispatch_entries',
-                target_id=entry.id,
-                details=f"Despachó producto {prod.name} / {prod.brand} (id {entry.product_id}): solicitado {qty}, enviado {dispatched}, OC {order_number or 'sin OC'}"
-            ))
-
-        db.session.add(Log(
-            user_id=session['user_id'],
-            action='create_dispatch_batch',
-            target_table='dispatch_batches',
-            target_id=batch.id,
-            details=f"Creó despacho #{batch.id} para cliente {client.name} (OC {order_number or 'sin OC'})"
-        ))
+            log_rows.append({
+                'user_id': session['user_id'],
+                'action': 'dispatch_product',
+                'target_table': 'dispatch_entries',
+                'target_id': None,
+                'details': f"Despachó producto {prod.name} / {prod.brand} (id {prod.id}): solicitado {qty}, enviado {dispatched}, OC {order_number or 'sin OC'}"
+            })
 
+        # un solo INSERT con RETURNING en vez de un add+flush por entrada
+        entry_ids = db.session.execute(
+            DispatchEntry.__table__.insert()
+            .returning(DispatchEntry.id, sort_by_parameter_order=True),
+            entry_rows
+        ).scalars().all()
+        for log_row, eid in zip(log_rows, entry_ids):
+            log_row['target_id'] = eid
+
+        log_rows.append({
+            'user_id': session['user_id'],
+            'action': 'create_dispatch_batch',
+            'target_table': 'dispatch_batches',
+            'target_id': batch.id,
+            'details': f"Creó despacho #{batch.id} para cliente {client.name} (OC {order_number or 'sin OC'})"
+        })
+
+        # todos los logs del despacho en un solo INSERT
+        db.session.execute(Log.__table__.insert(), log_rows)
         db.session.commit()
 
         return jsonify(
@@ -158,34 +169,31 @@ def register_dispatches(app):
         if not cli_raw or not isinstance(items_data, list) or not items_data:
             return jsonify(error="Datos incompletos"), 400
 
-        client = Client.query.filter(Client.name.ilike(cli_raw)).first()
-        if not client:
-            client = Client(name=cli_raw)
-            db.session.add(client)
-            db.session.flush()
+        client = get_or_create_client(cli_raw)
         batch.client_id = client.id
         batch.order_number = ord_raw or None
 
         existing = {e.id: e for e in batch.entries}
         seen_ids = set()
 
+        cleaned = []
+        for idx, it in enumerate(items_data):
+            eid = it.get('entry_id')
+            raw_n = (it.get('name') or '').strip()
+            raw_b = (it.get('brand') or '').strip()
+            new_qty = it.get('quantity')
+
+            if not raw_n or not raw_b or not isinstance(new_qty, int) or new_qty < 0:
+                return jsonify(error=f"Línea {idx+1} inválida"), 400
+
+            cleaned.append((eid, clean_text(raw_n), clean_text(raw_b), new_qty))
+
+        # una sola consulta para todos los productos de la edición
+        index = products_by_name_brand(((n, b) for _, n, b, _ in cleaned), for_update=True)
+
         try:
-            for idx, it in enumerate(items_data):
-                eid = it.get('entry_id')
-                raw_n = (it.get('name') or '').strip()
-                raw_b = (it.get('brand') or '').strip()
-                new_qty = it.get('quantity')
-
-                if not raw_n or not raw_b or not isinstance(new_qty, int) or new_qty < 0:
-                    return jsonify(error=f"Línea {idx+1} inválida"), 400
-
-                name = clean_text(raw_n)
-                brand = clean_text(raw_b)
-
-                prod = Product.query.filter(
-                    Product.name.ilike(f"%{name}%"),
-                    Product.brand.ilike(f"%{brand}%")
-                ).first()
+            for idx, (eid, name, brand, new_qty) in enumerate(cleaned):
+                prod = index.get((name.lower(), brand.lower()))
                 if not prod:
                     return jsonify(error=f"Línea {idx+1}: producto '{name} / {brand}' no existe"), 400
 
@@ -207,15 +215,14 @@ def register_dispatches(app):
                         return jsonify(error=f"Línea {idx+1}: no hay suficiente stock para despachar {new_qty}"), 400
                     prod.stock -= new_qty
 
-                    entry = DispatchEntry(
+                    # sin flush por línea: las entradas nuevas nunca están
+                    # en 'existing', así que su id no participa en 'seen_ids'
+                    db.session.add(DispatchEntry(
                         batch_id=batch.id,
                         product_id=prod.id,
                         quantity=new_qty,
                         order_number=batch.order_number
-                    )
-                    db.session.add(entry)
-                    db.session.flush()
-                    seen_ids.add(entry.id)
+                    ))
 
             for old_id, old_entry in existing.items():
                 if old_id not in seen_ids:
@@ -240,35 +247,53 @@ def register_dispatches(app):
 
         query = DispatchBatch.query.join(DispatchBatch.user).join(DispatchBatch.client)
 
+        # filtrar sobre las tablas ya unidas; .has() emitiría un EXISTS
+        # correlacionado extra encima del mismo JOIN
         if op:
-            query = query.filter(DispatchBatch.user.has(Users.username.ilike(f"%{op}%")))
+            query = query.filter(Users.username.ilike(f"%{op}%"))
 
         if cl:
-            query = query.filter(DispatchBatch.client.has(Client.name.ilike(f"%{cl}%")))
+            query = query.filter(Client.name.ilike(f"%{cl}%"))
 
         if start:
             query = query.filter(DispatchBatch.created_at >= f"{start} 00:00:00")
         if end:
             query = query.filter(DispatchBatch.created_at <= f"{end} 23:59:59")
 
-        batches = query.order_by(DispatchBatch.created_at.desc()).all()
-        result = []
-        for b in batches:
-            result.append({
-                'batch_id': b.id,
-                'client': b.client.name,
-                'user': b.user.name,
-                'created_at': b.created_at.strftime('%d/%m/%Y %H:%M:%S'),
-                'items': [
-                    {
-                        'product': i.product.name,
-                        'brand': i.product.brand,
-                        'quantity': i.quantity
-                    }
-                    for i in b.entries
-                ]
-            })
-        return jsonify(result)
+        # user/client ya vienen unidos para los filtros; entries.product se
+        # precarga aparte para no serializar con lazy loading por lote
+        query = (query
+                 .options(
+                     contains_eager(DispatchBatch.user),
+                     contains_eager(DispatchBatch.client),
+                     selectinload(DispatchBatch.entries).joinedload(DispatchEntry.product))
+                 .order_by(DispatchBatch.created_at.desc()))
+
+        def _stream():
+            # respuesta en streaming: un lote a la vez en vez de armar la
+            # lista completa en memoria; yield_per acota el identity map
+            yield b'['
+            first = True
+            for b in query.yield_per(100):
+                chunk = orjson.dumps({
+                    'batch_id': b.id,
+                    'client': b.client.name,
+                    'user': b.user.name,
+                    'created_at': b.created_at.strftime('%d/%m/%Y %H:%M:%S'),
+                    'items': [
+                        {
+                            'product': i.product.name,
+                            'brand': i.product.brand,
+                            'quantity': i.quantity
+                        }
+                        for i in b.entries
+                    ]
+                })
+                yield chunk if first else b',' + chunk
+                first = False
+            yield b']'
+
+        return Response(stream_with_context(_stream()), mimetype='application/json')
 
     @app.route('/api/despachos/<int:batch_id>/fotos', methods=['GET', 'POST'])
     @login_required
@@ -280,12 +305,15 @@ def register_dispatches(app):
                       .filter_by(batch_id=batch.id)
                       .order_by(DispatchPhoto.created_at.desc())
                       .all())
+            # url_for recorre el mapa de rutas en cada llamada; el prefijo
+            # de static se resuelve una vez y se concatena por foto
+            static_prefix = url_for('static', filename='')
             out = []
             for p in photos:
                 out.append({
                     'id': p.id,
                     'stage': p.stage,
-                    'url': url_for('static', filename=p.path),
+                    'url': static_prefix + p.path,
                     'created_at': to_iso(getattr(p, "created_at", None))
                 })
             return jsonify(out)
@@ -299,14 +327,31 @@ def register_dispatches(app):
         if not is_allowed_file(file.filename):
             return jsonify(error="Formato no permitido"), 400
 
-        ext = file.filename.rsplit('.', 1)[1].lower()
-        fname = secure_filename(f"dispatch_{batch.id}_{stage}_{int(time.time())}.{ext}")
+        # siempre se guarda recomprimida como JPEG: las fotos de celular
+        # vienen en varios MB y luego infladas dentro del PDF
+        fname = secure_filename(f"dispatch_{batch.id}_{stage}_{int(time.time())}.jpg")
         rel_path = f"uploads/{fname}"
         save_path = os.path.join(current_app.config['UPLOAD_DIR'], fname)
         os.makedirs(current_app.config['UPLOAD_DIR'], exist_ok=True)
 
         try:
-            file.save(save_path)
+            im = Image.open(file.stream)
+            # aplicar la orientación EXIF antes de reescalar: el JPEG
+            # recomprimido pierde los metadatos y quedaría de lado
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((1600, 1600))
+            im = im.convert('RGB')
+            im.save(save_path, 'JPEG', quality=82,
+                    optimize=True, progressive=True)
+            # versión ~800px para el PDF: se redimensiona una sola vez
+            # aquí en vez de decodificar el original en cada render
+            im.thumbnail((800, 800))
+            im.save(f"{save_path}.thumb.jpg", 'JPEG', quality=85,
+                    optimize=True)
+        except (UnidentifiedImageError, OSError):
+            return jsonify(error="Archivo de imagen inválido"), 400
+
+        try:
             photo = DispatchPhoto(batch_id=batch.id, stage=stage, path=rel_path)
             db.session.add(photo)
             db.session.add(Log(
@@ -323,11 +368,12 @@ def register_dispatches(app):
             ), 201
         except SQLAlchemyError:
             db.session.rollback()
-            if os.path.exists(save_path):
-                try:
-                    os.remove(save_path)
-                except OSError:
-                    pass
+            for leftover in (save_path, f"{save_path}.thumb.jpg"):
+                if os.path.exists(leftover):
+                    try:
+                        os.remove(leftover)
+                    except OSError:
+                        pass
             return jsonify(error="No se pudo guardar la foto"), 500
 
     @app.route('/api/despachos/<int:batch_id>/fotos/<int:photo_id>', methods=['DELETE'])
@@ -349,11 +395,12 @@ def register_dispatches(app):
             db.session.rollback()
             return jsonify(error="No se pudo eliminar la foto"), 500
 
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except OSError:
-                pass
+        for stale in (file_path, f"{file_path}.thumb.jpg"):
+            if os.path.exists(stale):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
 
         return jsonify(message="Foto eliminada"), 200
 
@@ -366,10 +413,11 @@ def register_dispatches(app):
             joinedload(DispatchBatch.entries).joinedload(DispatchEntry.product),
             joinedload(DispatchBatch.photos)
         ).get_or_404(batch_id)
-        pdf_bytes = build_dispatch_pdf(batch)
+        pdf_stream = build_dispatch_pdf(batch)
         return send_file(
-            io.BytesIO(pdf_bytes),
+            pdf_stream,
             mimetype='application/pdf',
             download_name=f"despacho_{batch.id}.pdf",
-            as_attachment=True
+            as_attachment=True,
+            conditional=True
         )
@@ -1,8 +1,8 @@
 from datetime import timedelta
+from itertools import groupby
 from flask import jsonify, request, session
-from sqlalchemy import func
+from sqlalchemy import exists, func, select
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import joinedload
 
 from core.helpers import (
     admin_required,
@@ -22,7 +22,9 @@ from database.db import (
     Product,
     PurchaseOrder,
     PurchaseOrderItem,
+    Users,
     db,
+    products_by_name_brand,
 )
 
 
@@ -33,36 +35,51 @@ def register_inventory(app):
         start_s = request.args.get('start', '')
         end_s = request.args.get('end', '')
 
-        q = IngresoBatch.query.options(
-            joinedload(IngresoBatch.user),
-            joinedload(IngresoBatch.entries).joinedload(InventoryEntry.product)
-        ).order_by(IngresoBatch.id.desc())
+        # Proyección de columnas (sin hidratar instancias ORM): una sola
+        # consulta trae lote, usuario y entradas; el agrupado se hace en
+        # Python con groupby sobre el id de lote.
+        stmt = (
+            select(
+                IngresoBatch.id.label('batch_id'),
+                IngresoBatch.created_at,
+                Users.name.label('user_name'),
+                InventoryEntry.id.label('entry_id'),
+                Product.name.label('product_name'),
+                Product.brand.label('product_brand'),
+                InventoryEntry.quantity,
+            )
+            .select_from(IngresoBatch)
+            .outerjoin(Users, Users.id == IngresoBatch.user_id)
+            .outerjoin(InventoryEntry, InventoryEntry.ingreso_id == IngresoBatch.id)
+            .outerjoin(Product, Product.id == InventoryEntry.product_id)
+            .order_by(IngresoBatch.id.desc())
+        )
 
         start_dt = parse_dmy(start_s)
         end_dt = parse_dmy(end_s)
         if start_dt:
-            q = q.filter(IngresoBatch.created_at >= start_dt)
+            stmt = stmt.where(IngresoBatch.created_at >= start_dt)
         if end_dt:
-            q = q.filter(IngresoBatch.created_at < (end_dt + timedelta(days=1)))
+            stmt = stmt.where(IngresoBatch.created_at < (end_dt + timedelta(days=1)))
 
-        batches = q.all()
+        rows = db.session.execute(stmt).all()
 
         result = []
-        for b in batches:
-            user_name = getattr(getattr(b, 'user', None), 'name', None) or "—"
+        for (batch_id, created_at, user_name), group in groupby(
+                rows, key=lambda r: (r.batch_id, r.created_at, r.user_name)):
             items = [{
-                'entry_id': e.id,
+                'entry_id': r.entry_id,
                 'product': {
-                    'name': getattr(e.product, 'name', None),
-                    'brand': getattr(e.product, 'brand', None)
+                    'name': r.product_name,
+                    'brand': r.product_brand
                 },
-                'quantity': e.quantity
-            } for e in (b.entries or [])]
+                'quantity': r.quantity
+            } for r in group if r.entry_id is not None]
 
             result.append({
-                'batch_id': b.id,
-                'user': {'username': user_name},
-                'created_at': (b.created_at.isoformat() if getattr(b, 'created_at', None) else None),
+                'batch_id': batch_id,
+                'user': {'username': user_name or "—"},
+                'created_at': (created_at.isoformat() if created_at else None),
                 'items': items
             })
 
@@ -90,45 +107,47 @@ def register_inventory(app):
         if not isinstance(items, list) or not items:
             return jsonify(error="Envía un array 'items' con al menos un producto"), 400
 
-        batch = IngresoBatch(user_id=session['user_id'])
-        db.session.add(batch)
-        db.session.flush()
-
-        processed = []
+        cleaned = []
         for idx, it in enumerate(items):
-            raw_name = it.get('name', '')
-            raw_brand = it.get('brand', '')
             qty = it.get('quantity')
-
             if not isinstance(qty, int):
                 return jsonify(error=f"Ítem {idx}: 'quantity' debe ser entero"), 400
 
-            name = clean_text(raw_name)
-            brand = clean_text(raw_brand)
-
+            name = clean_text(it.get('name', ''))
+            brand = clean_text(it.get('brand', ''))
             if not name or not brand or qty <= 0:
                 return jsonify(error=f"Ítem {idx}: faltan campos o qty≤0"), 400
 
-            prod = Product.query.filter(
-                Product.name.ilike(f"%{name}%"),
-                Product.brand.ilike(f"%{brand}%")
-            ).first()
+            cleaned.append((name, brand, qty))
+
+        # todos los productos del lote en una sola consulta
+        index = products_by_name_brand(((n, b) for n, b, _ in cleaned), for_update=True)
+
+        batch = IngresoBatch(user_id=session['user_id'])
+        db.session.add(batch)
+        db.session.flush()
+
+        processed = []
+        log_rows = []
+        entry_rows = []
+        for name, brand, qty in cleaned:
+            prod = index.get((name.lower(), brand.lower()))
             if prod:
                 prod.stock += qty
             else:
                 prod = Product(name=name, brand=brand, stock=qty)
                 db.session.add(prod)
                 db.session.flush()
+                index[(name.lower(), brand.lower())] = prod
 
-            entry = InventoryEntry(
-                ingreso_id=batch.id,
-                product_id=prod.id,
-                quantity=qty
-            )
-            db.session.add(entry)
+            entry_rows.append({
+                'ingreso_id': batch.id,
+                'product_id': prod.id,
+                'quantity': qty
+            })
 
             processed.append({
-                'entry_id': entry.id,
+                'entry_id': None,
                 'product': {
                     'id': prod.id,
                     'name': prod.name,
@@ -136,20 +155,32 @@ def register_inventory(app):
                 },
                 'quantity': qty
             })
-            db.session.add(Log(
-                user_id=session['user_id'],
-                action='ingreso_producto',
-                target_table='inventory_entries',
-                target_id=entry.id,
-                details=f"Registró ingreso de {qty} unidad(es) del producto {prod.name} / {prod.brand} (id {entry.product_id}) en lote {batch.id}"
-            ))
-        db.session.add(Log(
-            user_id=session['user_id'],
-            action='create_ingreso_batch',
-            target_table='ingreso_batches',
-            target_id=batch.id,
-            details=f"Creó ingreso #{batch.id} con {len(processed)} ítems"
-        ))
+            log_rows.append({
+                'user_id': session['user_id'],
+                'action': 'ingreso_producto',
+                'target_table': 'inventory_entries',
+                'target_id': None,
+                'details': f"Registró ingreso de {qty} unidad(es) del producto {prod.name} / {prod.brand} (id {prod.id}) en lote {batch.id}"
+            })
+
+        # un solo INSERT con RETURNING en vez de un add+flush por entrada
+        entry_ids = db.session.execute(
+            InventoryEntry.__table__.insert()
+            .returning(InventoryEntry.id, sort_by_parameter_order=True),
+            entry_rows
+        ).scalars().all()
+        for item, log_row, eid in zip(processed, log_rows, entry_ids):
+            item['entry_id'] = eid
+            log_row['target_id'] = eid
+        log_rows.append({
+            'user_id': session['user_id'],
+            'action': 'create_ingreso_batch',
+            'target_table': 'ingreso_batches',
+            'target_id': batch.id,
+            'details': f"Creó ingreso #{batch.id} con {len(processed)} ítems"
+        })
+        # todos los logs del lote en un solo INSERT
+        db.session.execute(Log.__table__.insert(), log_rows)
         db.session.commit()
         return jsonify(
             message=f"Ingreso #{batch.id} creado con {len(processed)} ítems",
@@ -179,26 +210,29 @@ def register_inventory(app):
         existing = {e.id: e for e in batch.entries}
         seen = set()
 
+        cleaned = []
+        for idx, it in enumerate(items_new):
+            eid = it.get('entry_id')
+            qty = it.get('quantity')
+            rawn = it.get('product', '').strip()
+            rawb = it.get('brand', '').strip()
+
+            if not rawn or not rawb or not isinstance(qty, int) or qty < 0:
+                return jsonify(error=f"Línea {idx+1} inválida"), 400
+
+            cleaned.append((eid, clean_text(rawn), clean_text(rawb), qty))
+
+        # una sola consulta para todos los productos de la edición
+        index = products_by_name_brand(((n, b) for _, n, b, _ in cleaned), for_update=True)
+
         try:
-            for idx, it in enumerate(items_new):
-                eid = it.get('entry_id')
-                qty = it.get('quantity')
-                rawn = it.get('product', '').strip()
-                rawb = it.get('brand', '').strip()
-
-                if not rawn or not rawb or not isinstance(qty, int) or qty < 0:
-                    return jsonify(error=f"Línea {idx+1} inválida"), 400
-
-                name = clean_text(rawn)
-                brand = clean_text(rawb)
-                prod = Product.query.filter(
-                    Product.name.ilike(f"%{name}%"),
-                    Product.brand.ilike(f"%{brand}%")
-                ).first()
+            for idx, (eid, name, brand, qty) in enumerate(cleaned):
+                prod = index.get((name.lower(), brand.lower()))
                 if not prod:
                     prod = Product(name=name, brand=brand, stock=0)
                     db.session.add(prod)
                     db.session.flush()
+                    index[(name.lower(), brand.lower())] = prod
 
                 if eid and eid in existing:
                     entry = existing[eid]
@@ -212,14 +246,13 @@ def register_inventory(app):
                     seen.add(eid)
                 else:
                     prod.stock += qty
-                    entry = InventoryEntry(
+                    # sin flush por línea: las entradas nuevas nunca están
+                    # en 'existing', así que su id no participa en 'seen'
+                    db.session.add(InventoryEntry(
                         ingreso_id=batch.id,
                         product_id=prod.id,
                         quantity=qty
-                    )
-                    db.session.add(entry)
-                    db.session.flush()
-                    seen.add(entry.id)
+                    ))
 
             for oid, old in existing.items():
                 if oid not in seen:
@@ -246,9 +279,15 @@ def register_inventory(app):
         if not product:
             return jsonify(error="Producto no encontrado"), 404
 
-        inv_count = db.session.query(func.count(InventoryEntry.id)).filter(InventoryEntry.product_id == product_id).scalar()
-        dsp_count = db.session.query(func.count(DispatchEntry.id)).filter(DispatchEntry.product_id == product_id).scalar()
-        poi_count = db.session.query(func.count(PurchaseOrderItem.id)).filter(PurchaseOrderItem.product_id == product_id).scalar()
+        # los tres conteos en un solo round-trip
+        inv_count, dsp_count, poi_count = db.session.execute(select(
+            select(func.count(InventoryEntry.id))
+            .where(InventoryEntry.product_id == product_id).scalar_subquery(),
+            select(func.count(DispatchEntry.id))
+            .where(DispatchEntry.product_id == product_id).scalar_subquery(),
+            select(func.count(PurchaseOrderItem.id))
+            .where(PurchaseOrderItem.product_id == product_id).scalar_subquery(),
+        )).one()
 
         return jsonify({
             "product": {
@@ -415,12 +454,24 @@ def register_inventory(app):
         if not product:
             return jsonify(error="Producto no encontrado"), 404
 
-        inv_count = db.session.query(func.count(InventoryEntry.id)).filter(InventoryEntry.product_id == product_id).scalar() or 0
-        dsp_count = db.session.query(func.count(DispatchEntry.id)).filter(DispatchEntry.product_id == product_id).scalar() or 0
-        poi_count = db.session.query(func.count(PurchaseOrderItem.id)).filter(PurchaseOrderItem.product_id == product_id).scalar() or 0
-        total = inv_count + dsp_count + poi_count
-
-        if total > 0:
+        # EXISTS corta en la primera fila que referencia al producto;
+        # los conteos completos sólo se pagan para armar el error 409
+        has_refs = db.session.execute(select(
+            exists().where(InventoryEntry.product_id == product_id),
+            exists().where(DispatchEntry.product_id == product_id),
+            exists().where(PurchaseOrderItem.product_id == product_id),
+        )).one()
+
+        if any(has_refs):
+            inv_count, dsp_count, poi_count = db.session.execute(select(
+                select(func.count(InventoryEntry.id))
+                .where(InventoryEntry.product_id == product_id).scalar_subquery(),
+                select(func.count(DispatchEntry.id))
+                .where(DispatchEntry.product_id == product_id).scalar_subquery(),
+                select(func.count(PurchaseOrderItem.id))
+                .where(PurchaseOrderItem.product_id == product_id).scalar_subquery(),
+            )).one()
+            total = inv_count + dsp_count + poi_count
             return jsonify(
                 error="El producto tiene referencias y no puede eliminarse. Fusiona antes.",
                 usage={
@@ -484,21 +535,27 @@ def register_inventory(app):
             return jsonify(error=f"Productos fuente inexistentes: {sorted(faltantes)}"), 404
 
         try:
-            for src in src_objs:
-                InventoryEntry.query.filter_by(product_id=src.id).update({"product_id": target.id}, synchronize_session=False)
-                DispatchEntry.query.filter_by(product_id=src.id).update({"product_id": target.id}, synchronize_session=False)
-                PurchaseOrderItem.query.filter_by(product_id=src.id).update({"product_id": target.id}, synchronize_session=False)
-
-                target.stock = (target.stock or 0) + (src.stock or 0)
-
-                db.session.add(Log(
-                    user_id=session['user_id'],
-                    action='merge_product',
-                    target_table='products',
-                    target_id=target.id,
-                    details=f"Fusionó producto {src.id} en {target.id}; referencias movidas y stock sumado: {src.stock}"
-                ))
+            # tres UPDATEs en total (uno por tabla) en vez de tres por fuente
+            source_ids = [p.id for p in src_objs]
+            InventoryEntry.query.filter(InventoryEntry.product_id.in_(source_ids)) \
+                .update({"product_id": target.id}, synchronize_session=False)
+            DispatchEntry.query.filter(DispatchEntry.product_id.in_(source_ids)) \
+                .update({"product_id": target.id}, synchronize_session=False)
+            PurchaseOrderItem.query.filter(PurchaseOrderItem.product_id.in_(source_ids)) \
+                .update({"product_id": target.id}, synchronize_session=False)
+
+            target.stock = (target.stock or 0) + sum((p.stock or 0) for p in src_objs)
+
+            # un log por fuente para la auditoría, insertados en un solo lote
+            db.session.execute(Log.__table__.insert(), [{
+                'user_id': session['user_id'],
+                'action': 'merge_product',
+                'target_table': 'products',
+                'target_id': target.id,
+                'details': f"Fusionó producto {src.id} en {target.id}; referencias movidas y stock sumado: {src.stock}"
+            } for src in src_objs])
 
+            for src in src_objs:
                 db.session.delete(src)
 
             db.session.commit()
@@ -521,19 +578,27 @@ def register_inventory(app):
     @login_required
     def suggest_products():
         q = request.args.get('q', '').strip()
-        if not q:
+        # con menos de 2 caracteres el LIKE matchea media tabla por tecla
+        if len(q) < 2:
             return jsonify([])
 
-        matches = Product.query.filter(Product.name.ilike(f"%{q}%")).limit(10).all()
+        # proyección de columnas (sin hidratar ORM) y prefijos primero:
+        # el autocompletado casi siempre busca por inicio de nombre
+        rows = db.session.execute(
+            select(Product.id, Product.name, Product.brand, Product.stock)
+            .where(Product.name.ilike(f"%{q}%"))
+            .order_by(Product.name.ilike(f"{q}%").desc(), Product.name)
+            .limit(10)
+        ).all()
 
         return jsonify([
             {
-                'id': p.id,
-                'name': p.name,
-                'brand': p.brand,
-                'stock': p.stock
+                'id': r.id,
+                'name': r.name,
+                'brand': r.brand,
+                'stock': r.stock
             }
-            for p in matches
+            for r in rows
         ])
 
     @app.route('/api/inventario')
@@ -1,7 +1,9 @@
+from datetime import datetime
 from flask import jsonify, request
+from sqlalchemy import and_, func, or_, select
 
 from core.helpers import login_required, render_view
-from database.db import Log, Users
+from database.db import Log, Users, db
 
 
 def register_logs(app):
@@ -19,30 +21,79 @@ def register_logs(app):
         start = request.args.get('start')
         end = request.args.get('end')
 
-        q = Log.query.join(Log.user)
+        # Paginación keyset: 'before' es "<created_at iso>|<id>" de la
+        # última fila de la página anterior; evita OFFSET y acota memoria
+        # por request. El id desempata: los inserts de auditoría por lotes
+        # dejan timestamps repetidos y un corte de página dentro de un
+        # grupo empatado se saltaría el resto del grupo.
+        before_s = request.args.get('before', '').strip()
+        before_ts = before_id = None
+        if before_s:
+            try:
+                ts_part, _, id_part = before_s.partition('|')
+                before_ts = datetime.fromisoformat(ts_part)
+                if id_part:
+                    before_id = int(id_part)
+            except ValueError:
+                return jsonify(error="Parámetro 'before' inválido"), 400
+        try:
+            # clamp a [1, 500]: 0 rompería el cálculo del cursor y un
+            # negativo sería LIMIT -1 (sin tope) en SQLite
+            limit = max(1, min(int(request.args.get('limit', 200)), 500))
+        except ValueError:
+            return jsonify(error="Parámetro 'limit' inválido"), 400
+
+        # Proyección de columnas con la fecha ya formateada por SQLite:
+        # sin hidratar instancias Log ni llamar strftime por fila en Python.
+        q = (
+            select(
+                Log.id,
+                Users.username,
+                Log.action,
+                Log.target_table,
+                Log.target_id,
+                Log.details,
+                func.strftime('%d/%m/%Y %H:%M:%S', Log.created_at).label('created_at'),
+                Log.created_at.label('cursor_ts'),
+            )
+            .join(Users, Users.id == Log.user_id)
+        )
 
         if user_q:
-            q = q.filter(Users.username.ilike(f"%{user_q}%"))
+            q = q.where(Users.username.ilike(f"%{user_q}%"))
         if action_q:
-            q = q.filter(Log.action.ilike(f"%{action_q}%"))
+            q = q.where(Log.action.ilike(f"%{action_q}%"))
         if table_q:
-            q = q.filter(Log.target_table.ilike(f"%{table_q}%"))
+            q = q.where(Log.target_table.ilike(f"%{table_q}%"))
         if start:
-            q = q.filter(Log.created_at >= f"{start} 00:00:00")
+            q = q.where(Log.created_at >= f"{start} 00:00:00")
         if end:
-            q = q.filter(Log.created_at <= f"{end} 23:59:59")
-
-        entries = q.order_by(Log.created_at.desc()).all()
-
-        out = []
-        for e in entries:
-            out.append({
-                'id': e.id,
-                'user': e.user.username,
-                'action': e.action,
-                'table': e.target_table,
-                'target_id': e.target_id,
-                'details': e.details,
-                'created_at': e.created_at.strftime('%d/%m/%Y %H:%M:%S')
-            })
-        return jsonify(out)
+            q = q.where(Log.created_at <= f"{end} 23:59:59")
+        if before_ts is not None:
+            if before_id is not None:
+                q = q.where(or_(
+                    Log.created_at < before_ts,
+                    and_(Log.created_at == before_ts, Log.id < before_id),
+                ))
+            else:
+                # cursores viejos sin id: comportamiento anterior
+                q = q.where(Log.created_at < before_ts)
+
+        rows = db.session.execute(
+            q.order_by(Log.created_at.desc(), Log.id.desc()).limit(limit)
+        ).all()
+
+        items = [{
+            'id': r.id,
+            'user': r.username,
+            'action': r.action,
+            'table': r.target_table,
+            'target_id': r.target_id,
+            'details': r.details,
+            'created_at': r.created_at
+        } for r in rows]
+        next_cursor = (
+            f"{rows[-1].cursor_ts.isoformat()}|{rows[-1].id}"
+            if len(rows) == limit else None
+        )
+        return jsonify({'items': items, 'next_cursor': next_cursor})
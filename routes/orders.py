@@ -1,8 +1,7 @@
-import io
 from flask import jsonify, request, render_template, session, send_file
-from sqlalchemy import func
+from sqlalchemy import bindparam, func, or_
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload
 
 from core.helpers import clean_text, get_json_body, login_required, render_view
 from core.pdf_utils import build_order_pdf
@@ -15,22 +14,42 @@ from database.db import (
     PurchaseOrder,
     PurchaseOrderItem,
     db,
+    products_by_name_brand,
 )
 
+# presencia de columnas resuelta una sola vez al importar: el esquema no
+# cambia con el proceso corriendo, así que no hay que consultarlo por request
+_BATCH_HAS_ORDER_ID = 'order_id' in DispatchBatch.__table__.columns
+_BATCH_HAS_ORDER_NUMBER = 'order_number' in DispatchBatch.__table__.columns
+_ENTRY_HAS_ORDER_ID = 'order_id' in DispatchEntry.__table__.columns
+_ENTRY_HAS_ORDER_NUMBER = 'order_number' in DispatchEntry.__table__.columns
+
 
 def register_orders(app):
     @app.route('/ordenes', methods=['GET'])
     @login_required
     def ordenes_listado():
-        raw = PurchaseOrder.query.order_by(PurchaseOrder.created_at.desc()).all()
+        # dos consultas en total: órdenes con cliente/ítems precargados y
+        # un solo GROUP BY con lo despachado por número de orden, en vez
+        # de un SUM + lazy loads por cada orden del listado
+        raw = (PurchaseOrder.query
+               .options(joinedload(PurchaseOrder.client),
+                        selectinload(PurchaseOrder.items))
+               .order_by(PurchaseOrder.created_at.desc())
+               .all())
+        dispatched_map = dict(
+            db.session.query(
+                DispatchEntry.order_number,
+                func.coalesce(func.sum(DispatchEntry.quantity), 0)
+            )
+            .filter(DispatchEntry.order_number.isnot(None))
+            .group_by(DispatchEntry.order_number)
+            .all()
+        )
         orders = []
         for o in raw:
             total = sum(item.quantity for item in o.items)
-            dispatched = (
-                db.session.query(func.coalesce(func.sum(DispatchEntry.quantity), 0))
-                .filter(DispatchEntry.order_number == o.number)
-                .scalar()
-            )
+            dispatched = dispatched_map.get(o.number, 0)
             if dispatched >= total:
                 estado, badge = 'Completada', 'success'
             elif dispatched > 0:
@@ -73,6 +92,22 @@ def register_orders(app):
         if PurchaseOrder.query.filter_by(number=number_clean).first():
             return jsonify(error="Ya existe una orden con ese número"), 400
 
+        cleaned = []
+        for idx, it in enumerate(items):
+            qty = it.get('quantity')
+            if not isinstance(qty, int) or qty <= 0:
+                return jsonify(error=f"Línea {idx+1}: 'quantity' debe ser entero > 0"), 400
+
+            name = clean_text(it.get('name', ''))
+            brand = clean_text(it.get('brand', ''))
+            if not name or not brand:
+                return jsonify(error=f"Línea {idx+1}: faltan 'name' o 'brand'"), 400
+
+            cleaned.append((name, brand, qty))
+
+        # todos los productos de la orden en una sola consulta
+        index = products_by_name_brand((n, b) for n, b, _ in cleaned)
+
         client = Client.query.filter(Client.name.ilike(client_clean)).first()
         if not client:
             client = Client(name=client_clean)
@@ -84,62 +119,66 @@ def register_orders(app):
         db.session.flush()
 
         processed = []
+        items_payload = []
+        log_rows = []
         try:
-            for idx, it in enumerate(items):
-                raw_name = it.get('name', '')
-                raw_brand = it.get('brand', '')
-                qty = it.get('quantity')
-
-                if not isinstance(qty, int) or qty <= 0:
-                    db.session.rollback()
-                    return jsonify(error=f"Línea {idx+1}: 'quantity' debe ser entero > 0"), 400
-
-                name = clean_text(raw_name)
-                brand = clean_text(raw_brand)
-                if not name or not brand:
-                    db.session.rollback()
-                    return jsonify(error=f"Línea {idx+1}: faltan 'name' o 'brand'"), 400
-
-                prod = Product.query.filter(
-                    Product.name.ilike(f"%{name}%"),
-                    Product.brand.ilike(f"%{brand}%")
-                ).first()
-                if not prod:
+            # productos nuevos en un solo add_all + flush, no un flush por
+            # línea: los IDs recién hacen falta al armar los payloads
+            new_prods = []
+            for name, brand, _ in cleaned:
+                key = (name.lower(), brand.lower())
+                if key not in index:
                     prod = Product(name=name, brand=brand, stock=0)
-                    db.session.add(prod)
-                    db.session.flush()
-
-                poi = PurchaseOrderItem(
-                    order_id=po.id,
-                    product_id=prod.id,
-                    quantity=qty
-                )
-                db.session.add(poi)
+                    index[key] = prod
+                    new_prods.append(prod)
+            if new_prods:
+                db.session.add_all(new_prods)
                 db.session.flush()
 
+            for name, brand, qty in cleaned:
+                prod = index[(name.lower(), brand.lower())]
+
+                items_payload.append({
+                    'order_id': po.id,
+                    'product_id': prod.id,
+                    'quantity': qty
+                })
+
                 processed.append({
-                    'item_id': poi.id,
+                    'item_id': None,
                     'product_id': prod.id,
                     'name': prod.name,
                     'brand': prod.brand,
                     'quantity': qty
                 })
 
-                db.session.add(Log(
-                    user_id=session['user_id'],
-                    action='add_po_item',
-                    target_table='purchase_order_items',
-                    target_id=poi.id,
-                    details=f"Agregó a OC {po.number} el producto {prod.name} / {prod.brand} (id {prod.id}) por {qty} unidad(es)"
-                ))
-
-            db.session.add(Log(
-                user_id=session['user_id'],
-                action='create_purchase_order',
-                target_table='purchase_orders',
-                target_id=po.id,
-                details=f"Creó orden de compra {po.number} para cliente {client.name} con {len(processed)} ítems"
-            ))
+                log_rows.append({
+                    'user_id': session['user_id'],
+                    'action': 'add_po_item',
+                    'target_table': 'purchase_order_items',
+                    'target_id': None,
+                    'details': f"Agregó a OC {po.number} el producto {prod.name} / {prod.brand} (id {prod.id}) por {qty} unidad(es)"
+                })
+
+            # un INSERT con RETURNING para los ítems y otro para los logs,
+            # en vez de un par de round-trips por línea
+            poi_ids = db.session.execute(
+                PurchaseOrderItem.__table__.insert()
+                .returning(PurchaseOrderItem.id, sort_by_parameter_order=True),
+                items_payload
+            ).scalars().all()
+            for item, log_row, poi_id in zip(processed, log_rows, poi_ids):
+                item['item_id'] = poi_id
+                log_row['target_id'] = poi_id
+
+            log_rows.append({
+                'user_id': session['user_id'],
+                'action': 'create_purchase_order',
+                'target_table': 'purchase_orders',
+                'target_id': po.id,
+                'details': f"Creó orden de compra {po.number} para cliente {client.name} con {len(processed)} ítems"
+            })
+            db.session.execute(Log.__table__.insert(), log_rows)
 
             db.session.commit()
         except SQLAlchemyError:
@@ -159,14 +198,22 @@ def register_orders(app):
             joinedload(PurchaseOrder.items).joinedload(PurchaseOrderItem.product)
         ).get_or_404(order_id)
 
+        # lo despachado de todos los productos en un solo GROUP BY en vez
+        # de un agregado por ítem
+        desp_by_pid = dict(
+            db.session.query(
+                DispatchEntry.product_id,
+                func.coalesce(func.sum(DispatchEntry.quantity), 0)
+            )
+            .join(DispatchBatch, DispatchEntry.batch_id == DispatchBatch.id)
+            .filter(DispatchBatch.order_number == po.number)
+            .group_by(DispatchEntry.product_id)
+            .all()
+        )
+
         detail = []
         for it in po.items:
-            desp = db.session.query(func.coalesce(func.sum(DispatchEntry.quantity), 0)) \
-                .join(DispatchBatch, DispatchEntry.batch_id == DispatchBatch.id) \
-                .filter(
-                DispatchEntry.product_id == it.product_id,
-                DispatchBatch.order_number == po.number
-            ).scalar() or 0
+            desp = desp_by_pid.get(it.product_id, 0)
 
             detail.append({
                 'product': it.product.name,
@@ -175,9 +222,12 @@ def register_orders(app):
                 'pendiente': it.quantity - desp
             })
 
+        # selectinload para la colección: un joinedload aquí multiplica
+        # filas por despacho × entradas; el product (many-to-one) sí va
+        # joined dentro del SELECT IN
         batches = DispatchBatch.query.options(
             joinedload(DispatchBatch.user),
-            joinedload(DispatchBatch.entries).joinedload(DispatchEntry.product)
+            selectinload(DispatchBatch.entries).joinedload(DispatchEntry.product)
         ).filter_by(order_number=po.number) \
             .order_by(DispatchBatch.id.desc()) \
             .all()
@@ -209,12 +259,13 @@ def register_orders(app):
             joinedload(PurchaseOrder.client),
             joinedload(PurchaseOrder.items).joinedload(PurchaseOrderItem.product)
         ).get_or_404(order_id)
-        pdf_bytes = build_order_pdf(order)
+        pdf_stream = build_order_pdf(order)
         return send_file(
-            io.BytesIO(pdf_bytes),
+            pdf_stream,
             mimetype='application/pdf',
             download_name=f"orden_{order.number}.pdf",
-            as_attachment=True
+            as_attachment=True,
+            conditional=True
         )
 
     @app.route('/api/ordenes/<int:order_id>', methods=['DELETE'])
@@ -225,23 +276,23 @@ def register_orders(app):
             return jsonify({'error': 'Orden no encontrada'}), 404
 
         try:
-            if 'order_id' in DispatchBatch.__table__.columns:
-                (db.session.query(DispatchBatch)
-                 .filter(DispatchBatch.order_id == po.id)
-                 .update({DispatchBatch.order_id: None}, synchronize_session=False))
-            if 'order_number' in DispatchBatch.__table__.columns:
-                (db.session.query(DispatchBatch)
-                 .filter(DispatchBatch.order_number == po.number)
-                 .update({DispatchBatch.order_number: None}, synchronize_session=False))
-
-            if 'order_id' in DispatchEntry.__table__.columns:
-                (db.session.query(DispatchEntry)
-                 .filter(DispatchEntry.order_id == po.id)
-                 .update({DispatchEntry.order_id: None}, synchronize_session=False))
-            if 'order_number' in DispatchEntry.__table__.columns:
-                (db.session.query(DispatchEntry)
-                 .filter(DispatchEntry.order_number == po.number)
-                 .update({DispatchEntry.order_number: None}, synchronize_session=False))
+            # una sola UPDATE por tabla: ambas columnas apuntan a la misma
+            # orden, así que se filtran con OR y se anulan juntas
+            for model, has_id, has_number in (
+                (DispatchBatch, _BATCH_HAS_ORDER_ID, _BATCH_HAS_ORDER_NUMBER),
+                (DispatchEntry, _ENTRY_HAS_ORDER_ID, _ENTRY_HAS_ORDER_NUMBER),
+            ):
+                values, conds = {}, []
+                if has_id:
+                    values[model.order_id] = None
+                    conds.append(model.order_id == po.id)
+                if has_number:
+                    values[model.order_number] = None
+                    conds.append(model.order_number == po.number)
+                if conds:
+                    (db.session.query(model)
+                     .filter(or_(*conds))
+                     .update(values, synchronize_session=False))
 
             db.session.query(PurchaseOrderItem) \
                 .filter(PurchaseOrderItem.order_id == po.id) \
@@ -265,16 +316,20 @@ def register_orders(app):
     def api_orden_detalle(order_number):
         po = PurchaseOrder.query.filter_by(number=order_number).first_or_404()
 
+        # mismo patrón que orden_detalle: un único GROUP BY por producto
+        desp_by_pid = dict(
+            db.session.query(
+                DispatchEntry.product_id,
+                func.coalesce(func.sum(DispatchEntry.quantity), 0)
+            )
+            .filter(DispatchEntry.order_number == po.number)
+            .group_by(DispatchEntry.product_id)
+            .all()
+        )
+
         result = []
         for it in po.items:
-            desp = (
-                db.session.query(func.coalesce(func.sum(DispatchEntry.quantity), 0))
-                .filter(
-                    DispatchEntry.order_number == po.number,
-                    DispatchEntry.product_id == it.product_id
-                )
-                .scalar()
-            )
+            desp = desp_by_pid.get(it.product_id, 0)
             result.append({
                 'product_id': it.product_id,
                 'product': it.product.name,
@@ -340,6 +395,7 @@ def register_orders(app):
         existing = {it.id: it for it in po.items}
         incoming_ids = set()
 
+        cleaned = []
         for idx, it in enumerate(items_data):
             pid = it.get('item_id')
             raw_n = it.get('product', '')
@@ -349,34 +405,60 @@ def register_orders(app):
             if not raw_n or not raw_b or not isinstance(qty, int) or qty <= 0:
                 return jsonify(error=f"Línea {idx+1} inválida"), 400
 
-            name = clean_text(raw_n)
-            brand = clean_text(raw_b)
+            cleaned.append((pid, clean_text(raw_n), clean_text(raw_b), qty))
+
+        # una sola consulta para todos los productos de la edición
+        index = products_by_name_brand((n, b) for _, n, b, _ in cleaned)
 
-            prod = Product.query.filter(
-                Product.name.ilike(f"%{name}%"),
-                Product.brand.ilike(f"%{brand}%")
-            ).first()
-            if not prod:
+        # productos nuevos en un solo add_all + flush en vez de uno por línea
+        new_prods = []
+        for _, name, brand, _ in cleaned:
+            key = (name.lower(), brand.lower())
+            if key not in index:
                 prod = Product(name=name, brand=brand, stock=0)
-                db.session.add(prod)
-                db.session.flush()
+                index[key] = prod
+                new_prods.append(prod)
+        if new_prods:
+            db.session.add_all(new_prods)
+            db.session.flush()
+
+        updates = []
+        inserts = []
+        for pid, name, brand, qty in cleaned:
+            prod = index[(name.lower(), brand.lower())]
 
             if pid and pid in existing:
-                existing[pid].quantity = qty
+                updates.append({'_id': pid, 'q': qty})
                 incoming_ids.add(pid)
             else:
-                poi = PurchaseOrderItem(
-                    order_id=po.id,
-                    product_id=prod.id,
-                    quantity=qty
-                )
-                db.session.add(poi)
-                db.session.flush()
-                incoming_ids.add(poi.id)
+                inserts.append({
+                    'order_id': po.id,
+                    'product_id': prod.id,
+                    'quantity': qty
+                })
 
-        for eid, itobj in existing.items():
-            if eid not in incoming_ids:
-                db.session.delete(itobj)
+        # una sentencia por tipo de cambio (UPDATE/INSERT/DELETE) en vez
+        # de un round-trip por línea
+        to_delete = [eid for eid in existing if eid not in incoming_ids]
+        if updates:
+            db.session.execute(
+                PurchaseOrderItem.__table__.update()
+                .where(PurchaseOrderItem.id == bindparam('_id'))
+                .values(quantity=bindparam('q')),
+                updates
+            )
+        if inserts:
+            new_ids = db.session.execute(
+                PurchaseOrderItem.__table__.insert()
+                .returning(PurchaseOrderItem.id, sort_by_parameter_order=True),
+                inserts
+            ).scalars().all()
+            incoming_ids.update(new_ids)
+        if to_delete:
+            db.session.execute(
+                PurchaseOrderItem.__table__.delete()
+                .where(PurchaseOrderItem.id.in_(to_delete))
+            )
 
         db.session.add(Log(
             user_id=session['user_id'],
@@ -1,26 +1,33 @@
 from flask import jsonify, session
+from sqlalchemy import select, update
 from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.security import check_password_hash, generate_password_hash
 
 from core.helpers import clean_text, get_json_body, login_required, render_view
-from database.db import Log, Users, db
+from core.log_writer import log_inline
+from database.db import Users, db
 
 
 def register_profile(app):
     @app.route('/perfil', methods=['GET'])
     @login_required
     def perfil():
-        user = Users.query.get_or_404(session['user_id'])
+        # los datos del perfil viven en la sesión firmada desde el login;
+        # sólo las sesiones anteriores al cambio necesitan el fetch
+        if 'username' not in session or 'email' not in session:
+            user = Users.query.get_or_404(session['user_id'])
+            session['username'] = user.username
+            session['email'] = user.email
         return render_view('perfil.html',
-                           username=user.username,
-                           name=user.name,
-                           email=user.email)
+                           username=session['username'],
+                           name=session.get('name'),
+                           email=session['email'])
 
     @app.route('/api/perfil', methods=['POST'])
     @login_required
     def api_actualizar_perfil():
-        user = Users.query.get_or_404(session['user_id'])
-        old_name = user.name
-        old_email = user.email
+        old_name = session.get('name')
+        old_email = session.get('email')
         data = get_json_body()
         name = clean_text(data.get('name'))
         email = clean_text(data.get('email'))
@@ -28,16 +35,22 @@ def register_profile(app):
             return jsonify(error="Nombre y email son obligatorios"), 400
 
         try:
-            user.name = name
-            user.email = email
-            db.session.add(Log(
+            # un solo UPDATE, sin SELECT previo
+            db.session.execute(
+                update(Users)
+                .where(Users.id == session['user_id'])
+                .values(name=name, email=email)
+            )
+            log_inline(
                 user_id=session['user_id'],
                 action='update_profile',
                 target_table='users',
-                target_id=user.id,
-                details=f"Actualizó su perfil: nombre '{old_name}' -> '{user.name}', correo '{old_email}' -> '{user.email}'"
-            ))
+                target_id=session['user_id'],
+                details=f"Actualizó su perfil: nombre '{old_name}' -> '{name}', correo '{old_email}' -> '{email}'"
+            )
             db.session.commit()
+            session['name'] = name
+            session['email'] = email
             return jsonify(message="Perfil actualizado"), 200
         except SQLAlchemyError:
             db.session.rollback()
@@ -46,7 +59,6 @@ def register_profile(app):
     @app.route('/api/perfil/password', methods=['POST'])
     @login_required
     def api_cambiar_password():
-        user = Users.query.get_or_404(session['user_id'])
         data = get_json_body()
         old = data.get('old_pass', '')
         new = data.get('new_pass', '')
@@ -56,18 +68,27 @@ def register_profile(app):
             return jsonify(error="Todos los campos de contraseña son obligatorios"), 400
         if new != rep:
             return jsonify(error="Las contraseñas nuevas no coinciden"), 400
-        if not user.check_password(old):
+
+        # sólo la columna del hash, no la fila completa
+        stored_hash = db.session.execute(
+            select(Users._password).where(Users.id == session['user_id'])
+        ).scalar_one_or_none()
+        if stored_hash is None or not check_password_hash(stored_hash, old):
             return jsonify(error="Contraseña actual incorrecta"), 400
 
         try:
-            user.password = new
-            db.session.add(Log(
+            db.session.execute(
+                update(Users)
+                .where(Users.id == session['user_id'])
+                .values(_password=generate_password_hash(new))
+            )
+            log_inline(
                 user_id=session['user_id'],
                 action='change_password',
                 target_table='users',
-                target_id=user.id,
+                target_id=session['user_id'],
                 details="Cambió su contraseña desde la pantalla de perfil"
-            ))
+            )
             db.session.commit()
             return jsonify(message="Contraseña cambiada"), 200
         except SQLAlchemyError:
@@ -82,15 +103,18 @@ def register_profile(app):
         if theme not in ('dark', 'light'):
             return jsonify(error="Tema inválido"), 400
 
-        user = Users.query.get(session['user_id'])
-        user.theme = theme
-        db.session.add(Log(
+        db.session.execute(
+            update(Users)
+            .where(Users.id == session['user_id'])
+            .values(theme=theme)
+        )
+        log_inline(
             user_id=session['user_id'],
             action='change_theme',
             target_table='users',
-            target_id=user.id,
+            target_id=session['user_id'],
             details=f"Cambió el tema de la interfaz a '{theme}'"
-        ))
+        )
         db.session.commit()
         session['theme'] = theme
         return jsonify(message="Tema actualizado"), 200
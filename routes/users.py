@@ -1,8 +1,11 @@
 from flask import abort, jsonify, request, session
+from sqlalchemy import delete, update
 from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.security import generate_password_hash
 
 from core.helpers import admin_required, clean_text, get_json_body, render_view
-from database.db import Log, Users, db
+from core.log_writer import log_inline
+from database.db import Users, db
 
 
 def register_users(app):
@@ -28,13 +31,13 @@ def register_users(app):
                 user.name = clean_text(data.get("name"))
                 user.email = clean_text(data.get("email"))
                 user.is_Admin = bool(data["is_Admin"])
-                db.session.add(Log(
+                log_inline(
                     user_id=session['user_id'],
                     action='edit_user',
                     target_table='users',
                     target_id=user.id,
                     details=f"Editó usuario {user.username}: nombre '{user.name}', correo '{user.email}', admin={user.is_Admin}"
-                ))
+                )
                 db.session.commit()
                 return jsonify({"message": "Usuario actualizado"}), 200
             except SQLAlchemyError:
@@ -44,21 +47,29 @@ def register_users(app):
     @app.route('/usuarios/editar/password/<id>', methods=["POST"])
     @admin_required
     def usuarios_edit_password(id):
-        user = Users.query.get_or_404(id)
-
         default_pwd = "changeme123"
         try:
-            user.password = default_pwd
-            db.session.add(Log(
+            # UPDATE directo con RETURNING: sin SELECT previo ni fila
+            # completa en el identity map
+            row = db.session.execute(
+                update(Users)
+                .where(Users.id == id)
+                .values(_password=generate_password_hash(default_pwd))
+                .returning(Users.id, Users.username)
+            ).first()
+            if row is None:
+                db.session.rollback()
+                abort(404)
+            log_inline(
                 user_id=session['user_id'],
                 action='reset_password',
                 target_table='users',
-                target_id=user.id,
-                details=f"Restableció contraseña de {user.username} al valor temporal por defecto"
-            ))
+                target_id=row.id,
+                details=f"Restableció contraseña de {row.username} al valor temporal por defecto"
+            )
             db.session.commit()
             return jsonify({
-                "message": f"Contraseña de usuario {user.username} restablecida a '{default_pwd}'"
+                "message": f"Contraseña de usuario {row.username} restablecida a '{default_pwd}'"
             }), 200
 
         except SQLAlchemyError:
@@ -68,19 +79,27 @@ def register_users(app):
     @app.route('/usuarios/eliminar/<id>', methods=["POST"])
     @admin_required
     def usuarios_delete(id):
-        user = Users.query.get(id)
-        if not user:
-            abort(404)
         try:
-            db.session.delete(user)
-            db.session.add(Log(
+            # DELETE directo con RETURNING en vez de cargar la fila
+            row = db.session.execute(
+                delete(Users)
+                .where(Users.id == id)
+                .returning(Users.id, Users.username)
+            ).first()
+            if row is None:
+                db.session.rollback()
+                abort(404)
+            log_inline(
                 user_id=session['user_id'],
                 action='delete_user',
                 target_table='users',
-                target_id=user.id,
-                details=f"Eliminó usuario {user.username} (id {user.id})"
-            ))
+                target_id=row.id,
+                details=f"Eliminó usuario {row.username} (id {row.id})"
+            )
             db.session.commit()
+            # pudo haberse borrado el último usuario: ensure_first_user
+            # vuelve a sondear la base y reabre /setup si quedó vacía
+            app._has_any_user = False
         except SQLAlchemyError:
             db.session.rollback()
             return jsonify({"error": "No se pudo eliminar el usuario"}), 500
@@ -103,13 +122,13 @@ def register_users(app):
                 is_Admin=bool(data["is_Admin"])
             )
             db.session.add(new_user)
-            db.session.add(Log(
+            log_inline(
                 user_id=session['user_id'],
                 action='create_user',
                 target_table='users',
                 target_id=new_user.id,
                 details=f"Creó usuario {new_user.username} (admin={new_user.is_Admin}, correo {new_user.email})"
-            ))
+            )
             db.session.commit()
         except SQLAlchemyError:
             db.session.rollback()